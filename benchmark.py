@@ -0,0 +1,342 @@
+"""
+Benchmark offline do pipeline de coleta contra um feed falso do Pinterest servido localmente.
+
+Sobe um servidor aiohttp com uma página de rolagem infinita que usa a mesma marcação
+do Pinterest (div[data-test-id="pin"], links /pin/<id>/, imagens no formato das URLs
+do i.pinimg.com) e os mesmos recursos JSON /resource/...Resource/get/, além de um
+servidor de imagens. Em seguida roda o pipeline real (coleta, download e banco) e
+mede pins/s, imagens/s, latência p50/p99 por etapa e pico de memória (RSS).
+
+Uso:
+    python benchmark.py --pins 2000 --mode batch
+    python benchmark.py --pins 2000 --mode network --postgres   # usa o banco do .env
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from aiohttp import web
+
+import database
+import image_urls
+import metrics
+import pinterest_scrapper as scraper
+import schema
+import storage
+
+FEED_PAGE = """<!doctype html>
+<html lang="pt-BR">
+<head><meta charset="utf-8"><title>Feed de benchmark</title></head>
+<body>
+<div aria-label="Feed de início" id="feed"></div>
+<script>
+let bookmark = null, loading = false, finished = false;
+
+async function loadMore() {
+    if (loading || finished) return;
+    loading = true;
+    // Paginação no formato do Pinterest: o bookmark da resposta anterior vai em data.options.bookmarks
+    const data = JSON.stringify({options: {bookmarks: bookmark ? [bookmark] : []}});
+    const response = await fetch(`/resource/BenchFeedResource/get/?data=${encodeURIComponent(data)}`);
+    const payload = await response.json();
+    const pins = payload.resource_response.data;
+    bookmark = payload.resource_response.bookmark;
+    finished = pins.length === 0 || bookmark === '-end-';
+    const feed = document.getElementById('feed');
+    for (const pin of pins) {
+        const node = document.createElement('div');
+        node.setAttribute('data-test-id', 'pin');
+        node.style.height = '320px';
+        const srcset = ['236x', '474x', '736x', 'orig'].map((size, i) => `${pin.images[size].url} ${i + 1}x`).join(', ');
+        node.innerHTML = `<a href="/pin/${pin.id}/"><img src="${pin.images['236x'].url}" srcset="${srcset}" alt=""></a>`
+            + `<div data-test-id="pin-title">${pin.grid_title}</div>`
+            + `<div data-test-id="pin-description">${pin.description}</div>`;
+        feed.appendChild(node);
+    }
+    loading = false;
+}
+
+window.addEventListener('scroll', () => {
+    if (window.innerHeight + window.scrollY >= document.body.scrollHeight - 1500) loadMore();
+});
+loadMore();
+</script>
+</body>
+</html>
+"""
+
+IMAGE_SIZES = ("236x", "474x", "736x", "originals")
+# Largura servida em cada variante (a altura é 1,5x a largura, como um pin típico)
+IMAGE_WIDTHS = {"236x": 236, "474x": 474, "736x": 736, "originals": 1200}
+
+
+# Etapas reportadas e os histogramas do scraper que as medem
+STAGE_METRICS = {
+    "scroll_wait": "scroll.wait.seconds",
+    "extraction": "extraction.seconds",
+    "download": "download.seconds",
+    "db_flush": "db.flush.seconds"
+}
+
+
+def _stage_latency(name):
+    histogram = metrics.histogram(name)
+    return {
+        "count": histogram.count,
+        "p50_ms": round((histogram.percentile(0.50) or 0.0) * 1000, 2),
+        "p99_ms": round((histogram.percentile(0.99) or 0.0) * 1000, 2)
+    }
+
+
+class FakePinterestFeed:
+    """Servidor local com o feed de rolagem infinita, os recursos JSON e as imagens."""
+
+    def __init__(self, total_pins: int, page_size: int, image_bytes: int, image_latency: float):
+        self.total_pins = total_pins
+        self.page_size = page_size
+        self.image_latency = image_latency
+        self.image_bodies = {size: self._image_body(size, image_bytes) for size in IMAGE_SIZES}
+        self.base_url = None
+        self._runner = None
+
+    @staticmethod
+    def _image_body(size: str, image_bytes: int) -> bytes:
+        """
+        Corpo servido para uma variante. Com o Pillow, um JPEG real nas dimensões da
+        variante (para medir a transcodificação); sem ele, um cabeçalho JPEG seguido de
+        bytes aleatórios, com `image_bytes` na 236x e crescendo com a área nas maiores.
+        """
+        width = IMAGE_WIDTHS[size]
+        if storage.Image is not None:
+            import io
+            noise = storage.Image.effect_noise((width, width * 3 // 2), 40).convert("RGB")
+            buffer = io.BytesIO()
+            noise.save(buffer, format="JPEG", quality=90)
+            return buffer.getvalue()
+        scaled = image_bytes * (width / IMAGE_WIDTHS["236x"]) ** 2
+        return b"\xff\xd8\xff\xe0" + os.urandom(max(0, int(scaled) - 4))
+
+    def _image_path(self, size: str, pin_id: int) -> str:
+        digest = hashlib.md5(str(pin_id).encode()).hexdigest()
+        return f"/{size}/{digest[:2]}/{digest[2:4]}/{digest[4:6]}/{digest}.jpg"
+
+    def _pin_object(self, index: int) -> dict:
+        pin_id = 10 ** 15 + index
+        return {
+            "type": "pin",
+            "id": str(pin_id),
+            "grid_title": f"Pin de benchmark {index}",
+            "description": f"Descrição sintética do pin {index}",
+            "images": {
+                size if size != "originals" else "orig": {
+                    "url": f"{self.base_url}{self._image_path(size, pin_id)}",
+                    "width": IMAGE_WIDTHS[size],
+                    "height": IMAGE_WIDTHS[size] * 3 // 2
+                }
+                for size in IMAGE_SIZES
+            }
+        }
+
+    async def _feed(self, request):
+        return web.Response(text=FEED_PAGE, content_type="text/html")
+
+    async def _resource(self, request):
+        try:
+            bookmarks = json.loads(request.query.get("data", "{}"))["options"]["bookmarks"]
+            page = int(bookmarks[0]) if bookmarks else 0
+        except (KeyError, ValueError, TypeError):
+            page = 0
+        start = page * self.page_size
+        end = min(start + self.page_size, self.total_pins)
+        pins = [self._pin_object(index) for index in range(start, end)]
+        bookmark = str(page + 1) if end < self.total_pins else "-end-"
+        return web.json_response({"resource_response": {"data": pins, "bookmark": bookmark}})
+
+    async def _image(self, request):
+        if self.image_latency:
+            await asyncio.sleep(self.image_latency)
+        # O nome do arquivo no fim (depois do fim do JPEG) deixa o conteúdo de cada pin único
+        body = self.image_bodies[request.match_info["size"]] + request.match_info["name"].encode()
+        return web.Response(body=body, content_type="image/jpeg")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/feed/", self._feed)
+        app.router.add_get("/resource/{name}/get/", self._resource)
+        app.router.add_get("/{size}/{a}/{b}/{c}/{name}", self._image)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+class SinkIngestor:
+    """Substituto do ImageIngestor que só descarta os lotes, simulando a latência do banco."""
+
+    def __init__(self, batch_size: int = database.DB_BATCH_SIZE, flush_latency: float = 0.0):
+        self.batch_size = batch_size
+        self.flush_latency = flush_latency
+        self.inserted_total = 0
+        self.duplicate_total = 0
+        self.failed_total = 0
+        self._buffer = []
+        self._seen = set()
+
+    def start(self):
+        pass
+
+    async def add(self, image_data: dict):
+        self._buffer.append(image_data)
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return 0, 0
+        with metrics.timer("db.flush.seconds"):
+            if self.flush_latency:
+                await asyncio.sleep(self.flush_latency)
+        inserted = 0
+        for image_data in batch:
+            if image_data["pinterest_id"] not in self._seen:
+                self._seen.add(image_data["pinterest_id"])
+                inserted += 1
+        self.inserted_total += inserted
+        self.duplicate_total += len(batch) - inserted
+        return inserted, len(batch) - inserted
+
+    async def close(self):
+        await self.flush()
+
+
+async def run_benchmark(args) -> dict:
+    feed = await FakePinterestFeed(args.pins, args.page_size, args.image_kb * 1024, args.image_latency_ms / 1000).start()
+    save_dir = tempfile.mkdtemp(prefix="bench_images_")
+
+    # Aponta o scraper para o servidor local e deixa o resto do pipeline intacto
+    scraper.COLLECTOR_MODE = args.mode
+    scraper.SCROLL_MODE = args.scroll_mode
+    scraper.PIN_IMAGE_URL_PREFIXES = (f"{feed.base_url}/", "data:image")
+    image_urls.IMAGE_TARGET_RESOLUTION = args.target_resolution
+    if args.no_delays:
+        scraper.SCROLL_PAUSE_TIME = 0
+        scraper.rate_limiter.LIMITER.enabled = False
+        scraper.SCROLL_MIN_INTERVAL = 0
+
+    pool = None
+    if args.postgres:
+        pool = await database.create_db_pool()
+        if not pool:
+            raise SystemExit("Não foi possível conectar ao Postgres configurado no .env.")
+        ingestor = database.ImageIngestor(pool)
+    else:
+        ingestor = SinkIngestor(flush_latency=args.sink_latency_ms / 1000)
+
+    try:
+        if pool:
+            await schema.migrate(pool)  # Mesmas tabelas e partições que o coletor usa
+        async with scraper.async_playwright() as p:
+            browser = await p.chromium.launch(headless=True, args=['--no-sandbox', '--disable-gpu'])
+            ingestor.start()
+            started = time.perf_counter()
+            async with storage.ImageDownloader(save_dir=save_dir, concurrency=args.download_concurrency,
+                                               transcode_format=args.transcode) as downloader:
+                pipeline = scraper.CrawlPipeline(downloader, ingestor)
+                pipeline.start()
+                try:
+                    targets = [f"{feed.base_url}/feed/"] * args.targets
+                    results = await scraper.crawl_targets(
+                        browser, targets, pipeline, database.SeenPinIndex(),
+                        concurrency=args.targets, budget=args.pins
+                    )
+                    await pipeline.drain()
+                finally:
+                    await pipeline.close()
+            elapsed = time.perf_counter() - started
+            await ingestor.close()
+            await browser.close()
+    finally:
+        if pool:
+            await pool.close()
+        await feed.stop()
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "mode": args.mode,
+        "scroll_mode": args.scroll_mode,
+        "pins_requested": args.pins,
+        "pins_collected": pipeline.collected,
+        "images_downloaded": downloader.stats["downloaded"],
+        "target_resolution": args.target_resolution,
+        "transcode_format": args.transcode or None,
+        "bytes_downloaded": downloader.stats["bytes"],
+        "bytes_stored": downloader.stats["bytes_stored"],
+        "bytes_per_image": round(downloader.stats["bytes"] / downloader.stats["downloaded"])
+        if downloader.stats["downloaded"] else 0,
+        "stored_bytes_per_image": round(metrics.histogram("download.file_size").summary()["mean"] or 0),
+        "images_transcoded": downloader.stats["transcoded"],
+        "rows_inserted": ingestor.inserted_total,
+        "elapsed_seconds": round(elapsed, 3),
+        "pins_per_second": round(pipeline.collected / elapsed, 2) if elapsed else 0.0,
+        # Imagens transcodificadas iguais viram "existing" no armazenamento, mas foram baixadas
+        "images_per_second": round((downloader.stats["downloaded"] + downloader.stats["existing"]) / elapsed, 2)
+        if elapsed else 0.0,
+        "stages": {stage: _stage_latency(metric) for stage, metric in STAGE_METRICS.items()},
+        # ru_maxrss vem em KiB no Linux; RUSAGE_CHILDREN cobre o navegador, que já foi encerrado
+        "peak_rss_mb": round(self_usage.ru_maxrss / 1024, 1),
+        "peak_rss_browser_mb": round(children_usage.ru_maxrss / 1024, 1),
+        "rate_limits": scraper.rate_limiter.LIMITER.rates(),
+        "targets": results,
+        "metrics": metrics.REGISTRY.summary()["metrics"]
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark offline do pipeline contra um feed falso local.")
+    parser.add_argument("--pins", type=int, default=500, help="número de pins do feed falso")
+    parser.add_argument("--page-size", type=int, default=25, help="pins por resposta do recurso JSON")
+    parser.add_argument("--mode", choices=("batch", "element", "network"), default="batch")
+    parser.add_argument("--scroll-mode", choices=("adaptive", "fixed"), default=scraper.SCROLL_MODE)
+    parser.add_argument("--targets", type=int, default=1, help="quantos alvos rolar em paralelo")
+    parser.add_argument("--image-kb", type=int, default=40,
+                        help="tamanho da variante 236x quando o Pillow não está instalado (as maiores crescem com a área)")
+    parser.add_argument("--target-resolution", choices=image_urls.PINIMG_SIZES, default=image_urls.IMAGE_TARGET_RESOLUTION)
+    parser.add_argument("--transcode", choices=("", "webp", "avif"), default=storage.IMAGE_TRANSCODE_FORMAT,
+                        help="transcodifica as imagens baixadas para este formato")
+    parser.add_argument("--image-latency-ms", type=float, default=0.0, help="latência artificial por imagem")
+    parser.add_argument("--download-concurrency", type=int, default=storage.DOWNLOAD_CONCURRENCY)
+    parser.add_argument("--postgres", action="store_true", help="grava no Postgres do .env em vez do sink")
+    parser.add_argument("--sink-latency-ms", type=float, default=0.0, help="latência simulada por lote no sink")
+    parser.add_argument("--no-delays", action="store_true", help="zera as pausas de rolagem e desliga o rate limiter")
+    parser.add_argument("--json", help="grava o relatório neste arquivo")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = asyncio.run(run_benchmark(args))
+    output = json.dumps(report, indent=2, default=str)
+    print(output)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
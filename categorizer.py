@@ -0,0 +1,309 @@
+"""
+Categorização das imagens baixadas com um modelo CLIP rodando só na CPU.
+
+Lê do banco as imagens ainda sem categoria, decodifica e redimensiona os arquivos do
+armazenamento local num pool de processos, calcula os embeddings em lotes e classifica
+cada imagem por zero-shot entre as categorias de CATEGORY_LABELS. Rótulo, score e
+embedding voltam para a tabela `images`. Os resultados ficam em cache por content_hash
+(tabela `image_embeddings`, criada pelas migrações de schema.py), então a mesma imagem
+nunca é avaliada duas vezes, mesmo que apareça em pins diferentes. Uma imagem quase
+igual a outra já avaliada (repostada com outra compressão ou tamanho, achada pelo hash
+perceptual) herda a categoria dela sem passar pelo modelo.
+
+Uso:
+    python categorizer.py                   # categoriza tudo o que falta
+    python categorizer.py --limit 1000      # no máximo 1000 imagens nesta execução
+    python categorizer.py --benchmark 256   # mede imagens/s sem gravar no banco
+"""
+import argparse
+import asyncio
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps
+
+import metrics
+import schema
+from database import PHASH_MAX_DISTANCE, create_db_pool, find_near_duplicates
+from settings import IMAGE_SAVE_DIR
+
+CATEGORY_LABELS = [
+    label.strip() for label in os.getenv(
+        "CATEGORY_LABELS",
+        "arte,arquitetura,comida,decoração,moda,natureza,animais,pessoas,viagem,tecnologia,texto,outros"
+    ).split(",") if label.strip()
+]
+CATEGORIZE_MODEL = os.getenv("CATEGORIZE_MODEL", "ViT-B-32")
+CATEGORIZE_PRETRAINED = os.getenv("CATEGORIZE_PRETRAINED", "laion2b_s34b_b79k")
+CATEGORIZE_BATCH_SIZE = int(os.getenv("CATEGORIZE_BATCH_SIZE", 64))
+CATEGORIZE_WORKERS = int(os.getenv("CATEGORIZE_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+CATEGORIZE_THREADS = int(os.getenv("CATEGORIZE_THREADS", os.cpu_count() or 1))
+CATEGORIZE_NEAR_DUPLICATES = os.getenv("CATEGORIZE_NEAR_DUPLICATES", "1") == "1"
+UNREADABLE_CATEGORY = "ilegível"  # Marca arquivos que não decodificam para não voltarem à fila
+
+IMAGE_SIZE = 224
+CLIP_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+CLIP_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+
+def preprocess_image(path: str):
+    """Decodifica, recorta ao centro e normaliza uma imagem para o CLIP. Retorna None se falhar."""
+    try:
+        with Image.open(path) as image:
+            image.draft("RGB", (IMAGE_SIZE * 2, IMAGE_SIZE * 2))  # Decodificação reduzida de JPEGs grandes
+            image = ImageOps.fit(image.convert("RGB"), (IMAGE_SIZE, IMAGE_SIZE), Image.BICUBIC)
+    except Exception:
+        return None
+    pixels = (np.asarray(image, dtype=np.float32) / 255.0 - CLIP_MEAN) / CLIP_STD
+    return pixels.transpose(2, 0, 1)
+
+
+class ClipCategorizer:
+    """Modelo CLIP na CPU com os embeddings de texto das categorias pré-calculados."""
+
+    def __init__(self, labels=CATEGORY_LABELS, model_name: str = CATEGORIZE_MODEL,
+                 pretrained: str = CATEGORIZE_PRETRAINED, threads: int = CATEGORIZE_THREADS):
+        import open_clip
+        import torch
+
+        torch.set_num_threads(threads)
+        self.torch = torch
+        self.labels = labels
+        self.model_id = f"{model_name}/{pretrained}"
+        self.model, _, _ = open_clip.create_model_and_transforms(model_name, pretrained=pretrained, device="cpu")
+        self.model.eval()
+        tokenizer = open_clip.get_tokenizer(model_name)
+        with torch.inference_mode():
+            text_features = self.model.encode_text(tokenizer([f"uma foto de {label}" for label in labels]))
+            self.text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+
+    def categorize(self, pixels: np.ndarray):
+        """Recebe um lote (N, 3, 224, 224) e devolve [(rótulo, score, embedding)] por imagem."""
+        with self.torch.inference_mode():
+            features = self.model.encode_image(self.torch.from_numpy(pixels))
+            features = features / features.norm(dim=-1, keepdim=True)
+            probabilities = (100.0 * features @ self.text_features.T).softmax(dim=-1)
+            scores, indices = probabilities.max(dim=-1)
+        return [
+            (self.labels[index], float(score), embedding.tolist())
+            for index, score, embedding in zip(indices.tolist(), scores, features.numpy())
+        ]
+
+
+async def fetch_uncategorized(pool, limit: int):
+    """Uma linha por conteúdo ainda sem categoria: [(content_hash, local_path)]."""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT DISTINCT ON (content_hash) content_hash, local_path
+            FROM images
+            WHERE category IS NULL AND content_hash IS NOT NULL AND local_path IS NOT NULL
+            LIMIT $1;
+            """,
+            limit
+        )
+    return [(row["content_hash"], row["local_path"]) for row in rows]
+
+
+async def apply_cached(pool, content_hashes):
+    """Copia para `images` as categorias já em cache. Retorna os hashes atendidos pelo cache."""
+    async with pool.acquire() as conn:
+        cached = await conn.fetch(
+            "SELECT content_hash, category, category_score, embedding FROM image_embeddings "
+            "WHERE content_hash = ANY($1::text[]);",
+            list(content_hashes)
+        )
+        if cached:
+            await conn.executemany(
+                "UPDATE images SET category = $2, category_score = $3, embedding = $4 "
+                "WHERE content_hash = $1 AND category IS NULL;",
+                [(row["content_hash"], row["category"], row["category_score"], row["embedding"]) for row in cached]
+            )
+    return {row["content_hash"] for row in cached}
+
+
+async def apply_near_duplicates(pool, content_hashes, max_distance: int = PHASH_MAX_DISTANCE):
+    """
+    Copia para as imagens de `content_hashes` a categoria em cache da imagem quase igual
+    mais próxima (pelo phash), gravando-a também no cache. Retorna os hashes atendidos.
+    """
+    if not CATEGORIZE_NEAR_DUPLICATES:
+        return set()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT DISTINCT ON (content_hash) content_hash, phash FROM images "
+            "WHERE content_hash = ANY($1::text[]) AND phash IS NOT NULL;",
+            list(content_hashes)
+        )
+    reused = []
+    for row in rows:
+        matches = [match["content_hash"] for match in await find_near_duplicates(
+            pool, row["phash"], max_distance, exclude_content_hash=row["content_hash"]) if match["content_hash"]]
+        if not matches:
+            continue
+        async with pool.acquire() as conn:
+            cached = await conn.fetch(
+                "SELECT content_hash, category, category_score, embedding, model FROM image_embeddings "
+                "WHERE content_hash = ANY($1::text[]) AND category <> $2;",
+                matches, UNREADABLE_CATEGORY
+            )
+        if cached:
+            nearest = min(cached, key=lambda entry: matches.index(entry["content_hash"]))
+            reused.append((row["content_hash"], nearest["category"], nearest["category_score"], nearest["embedding"],
+                           nearest["model"]))
+    if reused:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(
+                    "INSERT INTO image_embeddings (content_hash, category, category_score, embedding, model) "
+                    "VALUES ($1, $2, $3, $4, $5) ON CONFLICT (content_hash) DO NOTHING;",
+                    reused
+                )
+                await conn.executemany(
+                    "UPDATE images SET category = $2, category_score = $3, embedding = $4 "
+                    "WHERE content_hash = $1 AND category IS NULL;",
+                    [entry[:4] for entry in reused]
+                )
+    return {entry[0] for entry in reused}
+
+
+async def store_results(pool, results, model_id: str):
+    """Grava [(content_hash, rótulo, score, embedding)] no cache e em todas as linhas com o mesmo conteúdo."""
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.executemany(
+                "INSERT INTO image_embeddings (content_hash, category, category_score, embedding, model) "
+                "VALUES ($1, $2, $3, $4, $5) ON CONFLICT (content_hash) DO NOTHING;",
+                [(content_hash, label, score, embedding, model_id) for content_hash, label, score, embedding in results]
+            )
+            await conn.executemany(
+                "UPDATE images SET category = $2, category_score = $3, embedding = $4 "
+                "WHERE content_hash = $1 AND category IS NULL;",
+                results
+            )
+
+
+async def preprocess_batch(executor, paths):
+    """Decodifica um lote no pool de processos. Retorna (array do lote, índices que decodificaram)."""
+    loop = asyncio.get_running_loop()
+    with metrics.timer("categorize.decode.seconds"):
+        decoded = await asyncio.gather(*(loop.run_in_executor(executor, preprocess_image, path) for path in paths))
+    valid = [index for index, pixels in enumerate(decoded) if pixels is not None]
+    batch = np.stack([decoded[index] for index in valid]) if valid else None
+    return batch, valid
+
+
+async def categorize_pending(pool, categorizer: ClipCategorizer, executor, batch_size: int = CATEGORIZE_BATCH_SIZE,
+                             limit: int = None):
+    """Categoriza as imagens pendentes em lotes até acabarem (ou até `limit`). Retorna quantas foram avaliadas."""
+    scored = 0
+    handled = 0
+    while limit is None or handled < limit:
+        rows = await fetch_uncategorized(pool, batch_size if limit is None else min(batch_size, limit - handled))
+        if not rows:
+            break
+        handled += len(rows)
+
+        cached = await apply_cached(pool, [content_hash for content_hash, _ in rows])
+        metrics.counter("categorize.cache_hits").inc(len(cached))
+        rows = [row for row in rows if row[0] not in cached]
+        near = await apply_near_duplicates(pool, [content_hash for content_hash, _ in rows])
+        metrics.counter("categorize.near_duplicate_hits").inc(len(near))
+        rows = [row for row in rows if row[0] not in near]
+        if not rows:
+            continue
+
+        batch, valid = await preprocess_batch(executor, [path for _, path in rows])
+        results = []
+        if batch is not None:
+            with metrics.timer("categorize.model.seconds"):
+                predictions = await asyncio.to_thread(categorizer.categorize, batch)
+            results = [(rows[index][0], *prediction) for index, prediction in zip(valid, predictions)]
+        unreadable = [(rows[index][0], UNREADABLE_CATEGORY, None, None)
+                      for index in sorted(set(range(len(rows))) - set(valid))]
+        await store_results(pool, results + unreadable, categorizer.model_id)
+
+        scored += len(results)
+        metrics.counter("categorize.images").inc(len(results))
+        metrics.counter("categorize.unreadable").inc(len(unreadable))
+        print(f"Lote categorizado: {len(results)} imagens avaliadas, {len(cached)} do cache, "
+              f"{len(near)} de quase duplicatas, {len(unreadable)} ilegíveis.")
+    return scored
+
+
+async def run(limit: int = None):
+    pool = await create_db_pool()
+    if not pool:
+        print("Não foi possível estabelecer conexão com o banco de dados. Encerrando.")
+        return
+    try:
+        await schema.migrate(pool)
+        categorizer = ClipCategorizer()
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=CATEGORIZE_WORKERS) as executor:
+            scored = await categorize_pending(pool, categorizer, executor, limit=limit)
+        elapsed = time.perf_counter() - started
+        rate = scored / elapsed if elapsed else 0.0
+        print(f"--- Categorização concluída: {scored} imagens em {elapsed:.1f}s ({rate:.1f} imagens/s) ---")
+    finally:
+        await pool.close()
+
+
+async def benchmark(count: int, batch_size: int = CATEGORIZE_BATCH_SIZE):
+    """Mede decodificação, modelo e ponta a ponta em imagens/s usando arquivos do armazenamento local."""
+    paths = sorted(path for path in glob.glob(os.path.join(IMAGE_SAVE_DIR, "*", "*", "*"))
+                   if not path.endswith(".part"))[:count]
+    temp_dir = None
+    if not paths:
+        # Sem imagens baixadas: gera imagens sintéticas para medir o custo do modelo
+        import tempfile
+        temp_dir = tempfile.mkdtemp(prefix="categorize_bench_")
+        rng = np.random.default_rng(0)
+        for index in range(count):
+            path = os.path.join(temp_dir, f"{index}.jpg")
+            Image.fromarray(rng.integers(0, 255, (736, 552, 3), dtype=np.uint8)).save(path, quality=85)
+            paths.append(path)
+
+    categorizer = ClipCategorizer()
+    decode_seconds = model_seconds = 0.0
+    scored = 0
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=CATEGORIZE_WORKERS) as executor:
+        for offset in range(0, len(paths), batch_size):
+            decode_started = time.perf_counter()
+            batch, valid = await preprocess_batch(executor, paths[offset:offset + batch_size])
+            decode_seconds += time.perf_counter() - decode_started
+            if batch is None:
+                continue
+            model_started = time.perf_counter()
+            categorizer.categorize(batch)
+            model_seconds += time.perf_counter() - model_started
+            scored += len(valid)
+    elapsed = time.perf_counter() - started
+
+    if temp_dir:
+        import shutil
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    print(f"Imagens: {scored} (lotes de {batch_size}, {CATEGORIZE_WORKERS} processos de decodificação, "
+          f"{CATEGORIZE_THREADS} threads no modelo)")
+    print(f"Decodificação: {scored / decode_seconds if decode_seconds else 0:.1f} imagens/s")
+    print(f"Modelo:        {scored / model_seconds if model_seconds else 0:.1f} imagens/s")
+    print(f"Ponta a ponta: {scored / elapsed if elapsed else 0:.1f} imagens/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Categoriza as imagens baixadas com CLIP na CPU.")
+    parser.add_argument("--limit", type=int, help="máximo de imagens nesta execução")
+    parser.add_argument("--benchmark", type=int, metavar="N", help="mede imagens/s com N imagens, sem banco")
+    args = parser.parse_args()
+    if args.benchmark:
+        asyncio.run(benchmark(args.benchmark))
+    else:
+        asyncio.run(run(args.limit))
+
+
+if __name__ == "__main__":
+    main()
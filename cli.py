@@ -0,0 +1,76 @@
+"""
+Linha de comando do coletor, separada por etapa.
+
+Uso:
+    python cli.py crawl                  # navegador -> spool/crawl
+    python cli.py fetch                  # spool/crawl -> IMAGENS/ -> spool/fetch
+    python cli.py ingest                 # spool/fetch -> PostgreSQL, em lotes com COPY
+    python cli.py ingest --source crawl  # só os metadados; um ingest do fetch depois completa as imagens
+    python cli.py run                    # tudo num processo só (o mesmo que python pinterest_scrapper.py)
+
+Cada subcomando importa só o que sua etapa usa: crawl carrega o Playwright, fetch o
+aiohttp e ingest o asyncpg. As etapas trocam dados pelo spool local (spool.py), podem
+rodar em momentos diferentes e, se interrompidas, recomeçam do último checkpoint.
+O `run` guarda em spool/fetch os lotes que o banco recusar, e o `ingest` os grava depois.
+"""
+import argparse
+import asyncio
+import sys
+
+import metrics
+from settings import METRICS_OUTPUT, PROFILE_OUTPUT
+from spool import SPOOL_BATCH_SIZE
+
+
+def crawl(args):
+    from pinterest_scrapper import crawl_to_spool
+
+    return crawl_to_spool()
+
+
+def fetch(args):
+    from storage import fetch_from_spool
+
+    return fetch_from_spool(batch_size=args.batch)
+
+
+def ingest(args):
+    from database import ingest_from_spool
+
+    return ingest_from_spool(args.source, args.batch)
+
+
+def run(args):
+    from pinterest_scrapper import main as run_pipeline
+
+    return run_pipeline()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Coletor de imagens do Pinterest, uma etapa por subcomando.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("crawl", help="coleta os pins e grava no spool local").set_defaults(handler=crawl)
+    fetch_parser = subcommands.add_parser("fetch", help="baixa as imagens dos pins do spool")
+    fetch_parser.add_argument("--batch", type=int, default=SPOOL_BATCH_SIZE, help="pins por lote/checkpoint")
+    fetch_parser.set_defaults(handler=fetch)
+    ingest_parser = subcommands.add_parser("ingest", help="grava os pins do spool no banco")
+    ingest_parser.add_argument("--source", choices=("fetch", "crawl"), default="fetch",
+                               help="spool a gravar (crawl grava os pins sem imagem; um ingest do fetch "
+                                    "depois completa os que ficaram sem)")
+    ingest_parser.add_argument("--batch", type=int, default=SPOOL_BATCH_SIZE, help="pins por lote/checkpoint")
+    ingest_parser.set_defaults(handler=ingest)
+    subcommands.add_parser("run", help="coleta, baixa e grava no banco num processo só").set_defaults(handler=run)
+    args = parser.parse_args()
+
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
+    if PROFILE_OUTPUT:
+        metrics.profile_run(lambda: asyncio.run(args.handler(args)), PROFILE_OUTPUT)
+    else:
+        asyncio.run(args.handler(args))
+    if args.command != "run":  # O pipeline completo já grava o resumo das métricas
+        metrics.REGISTRY.write_json(METRICS_OUTPUT)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+"""
+Acesso ao PostgreSQL: pool de conexões, ingestão em lotes e índice de pins conhecidos.
+
+Só depende do asyncpg, então a etapa de ingestão não carrega o navegador nem o cliente HTTP.
+"""
+import asyncio
+import os
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from itertools import chain, combinations
+
+import asyncpg
+
+import metrics
+import schema
+from settings import IMAGE_STORAGE_FIELDS
+from spool import SPOOL_BATCH_SIZE, SpoolReader, SpoolWriter
+
+# Configurações do Banco de Dados
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = os.getenv("DB_PORT", "5432")
+DB_NAME = os.getenv("DB_NAME", "pinterest_images")
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+
+# Distância de Hamming máxima entre hashes perceptuais para considerar duas imagens quase iguais
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 6))
+
+# Configurações de ingestão no banco de dados
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 4))
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", 500))
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", 2.0))
+
+# Intervalo de atualização do índice de pins conhecidos e quantos `pin_ids.seq` abaixo do último
+# visto cada atualização relê (transações que pegaram o número antes mas confirmaram depois)
+SEEN_INDEX_REFRESH_INTERVAL = float(os.getenv("SEEN_INDEX_REFRESH_INTERVAL", 60))
+SEEN_INDEX_REFRESH_OVERLAP = int(os.getenv("SEEN_INDEX_REFRESH_OVERLAP", 10000))
+
+IMAGE_COLUMNS = ("pinterest_id", "title", "description", "image_url", "board_url", "pin_url", "collected_at",
+                 "local_path") + IMAGE_STORAGE_FIELDS
+
+
+async def create_db_pool():
+    """Cria o pool de conexões asyncpg usado pela ingestão."""
+    try:
+        pool = await asyncpg.create_pool(
+            host=DB_HOST,
+            port=int(DB_PORT),
+            database=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE
+        )
+        print("Pool de conexões com o banco de dados PostgreSQL criado com sucesso!")
+        return pool
+    except Exception as e:
+        print(f"Erro ao conectar ao PostgreSQL: {e}")
+        return None
+
+
+class ImageIngestor:
+    """
+    Acumula os dados dos pins em memória e grava em lotes no banco de dados.
+
+    O lote é descarregado quando atinge `batch_size` pins ou a cada `flush_interval`
+    segundos. Cada descarga faz um COPY para uma tabela temporária de staging e um
+    único INSERT ... SELECT na tabela `images`, só com os IDs que entraram em `pin_ids`.
+    Pins que já estavam no banco sem imagem (gravados de `ingest --source crawl`, por
+    exemplo) recebem o caminho local e os metadados da imagem se o lote os trouxer.
+
+    Com `fallback_spool`, um lote que o banco recusar (Postgres fora do ar, por exemplo)
+    vai para esse spool em vez de se perder, e um `python cli.py ingest` depois o grava.
+    """
+
+    def __init__(self, pool, batch_size: int = DB_BATCH_SIZE, flush_interval: float = DB_FLUSH_INTERVAL,
+                 fallback_spool: SpoolWriter = None):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fallback_spool = fallback_spool
+        self.inserted_total = 0
+        self.updated_total = 0
+        self.duplicate_total = 0
+        self.failed_total = 0
+        self.spooled_total = 0
+        self._buffer = []
+        self._lock = asyncio.Lock()
+        self._flusher_task = None
+
+    def start(self):
+        """Inicia a tarefa que descarrega o buffer periodicamente."""
+        if self._flusher_task is None:
+            self._flusher_task = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def add(self, image_data: dict):
+        """Adiciona um pin ao buffer, descarregando-o se o lote estiver cheio."""
+        self._buffer.append(tuple(image_data.get(column) for column in IMAGE_COLUMNS))
+        if len(self._buffer) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """Grava o buffer atual no banco. Retorna (inseridos, duplicados)."""
+        async with self._lock:
+            batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0, 0
+            started = time.perf_counter()
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        await conn.execute(
+                            """
+                            CREATE TEMP TABLE IF NOT EXISTS images_staging (
+                                pinterest_id TEXT,
+                                title TEXT,
+                                description TEXT,
+                                image_url TEXT,
+                                board_url TEXT,
+                                pin_url TEXT,
+                                collected_at TIMESTAMP,
+                                local_path TEXT,
+                                content_hash TEXT,
+                                mime_type TEXT,
+                                width INTEGER,
+                                height INTEGER,
+                                file_size BIGINT,
+                                phash BIGINT
+                            ) ON COMMIT DELETE ROWS;
+                            """
+                        )
+                        await conn.copy_records_to_table("images_staging", records=batch, columns=IMAGE_COLUMNS)
+                        # `images` é particionada: a unicidade do pinterest_id vem de `pin_ids`
+                        status = await conn.execute(
+                            """
+                            WITH new_ids AS (
+                                INSERT INTO pin_ids (pinterest_id)
+                                SELECT DISTINCT pinterest_id FROM images_staging
+                                ON CONFLICT (pinterest_id) DO NOTHING
+                                RETURNING pinterest_id
+                            )
+                            INSERT INTO images (pinterest_id, title, description, image_url, board_url, pin_url, collected_at,
+                                                local_path, content_hash, mime_type, width, height, file_size, phash)
+                            SELECT DISTINCT ON (pinterest_id)
+                                   pinterest_id, title, description, image_url, board_url, pin_url, collected_at,
+                                   local_path, content_hash, mime_type, width, height, file_size, phash
+                            FROM images_staging
+                            WHERE pinterest_id IN (SELECT pinterest_id FROM new_ids);
+                            """
+                        )
+                        # Completa com a imagem as linhas que já existiam sem ela (mesma regra do DownloadHandler)
+                        update_status = await conn.execute(
+                            """
+                            UPDATE images SET image_url = staged.image_url, local_path = staged.local_path,
+                                              content_hash = staged.content_hash, mime_type = staged.mime_type,
+                                              width = staged.width, height = staged.height,
+                                              file_size = staged.file_size, phash = staged.phash
+                            FROM (
+                                SELECT DISTINCT ON (pinterest_id) * FROM images_staging
+                                WHERE local_path IS NOT NULL
+                            ) AS staged
+                            WHERE images.pinterest_id = staged.pinterest_id AND images.local_path IS NULL;
+                            """
+                        )
+            except asyncpg.exceptions.PostgresError as e:
+                self.failed_total += len(batch)
+                metrics.counter("db.errors").inc()
+                print(f"Erro ao gravar lote de {len(batch)} pins no banco de dados: {e}")
+                self._spool_failed(batch)
+                return 0, 0
+            except Exception as e:
+                self.failed_total += len(batch)
+                metrics.counter("db.errors").inc()
+                print(f"Erro inesperado ao gravar lote de {len(batch)} pins: {e}")
+                self._spool_failed(batch)
+                return 0, 0
+            finally:
+                metrics.histogram("db.flush.seconds").observe(time.perf_counter() - started)
+
+            inserted = int(status.split()[-1])
+            updated = int(update_status.split()[-1])
+            duplicates = len(batch) - inserted - updated
+            self.inserted_total += inserted
+            self.updated_total += updated
+            self.duplicate_total += duplicates
+            metrics.counter("db.rows.inserted").inc(inserted)
+            metrics.counter("db.rows.updated").inc(updated)
+            metrics.counter("db.rows.duplicate").inc(duplicates)
+            metrics.counter("db.bytes").inc(sum(len(value) for row in batch for value in row if isinstance(value, str)))
+            print(f"Lote gravado no DB: {inserted} novos, {updated} completados com a imagem, "
+                  f"{duplicates} duplicados ({len(batch)} pins).")
+            return inserted, duplicates
+
+    def _spool_failed(self, batch):
+        """Guarda no `fallback_spool` um lote que não entrou no banco."""
+        if self.fallback_spool is None:
+            return
+        try:
+            for row in batch:
+                self.fallback_spool.append(dict(zip(IMAGE_COLUMNS, row)))
+            self.fallback_spool.sync()
+        except OSError as e:
+            print(f"Erro ao guardar no spool o lote de {len(batch)} pins recusado pelo banco: {e}")
+            return
+        self.spooled_total += len(batch)
+        metrics.counter("db.rows.spooled").inc(len(batch))
+        print(f"Lote de {len(batch)} pins guardado em {self.fallback_spool.path}; "
+              f"grave-o depois com `python cli.py ingest`.")
+
+    async def close(self):
+        """Para a descarga periódica e grava o que restou no buffer."""
+        if self._flusher_task is not None:
+            self._flusher_task.cancel()
+            try:
+                await self._flusher_task
+            except asyncio.CancelledError:
+                pass
+            self._flusher_task = None
+        await self.flush()
+
+
+def phash_bands(phash: int):
+    """As 4 faixas de 16 bits (sem sinal) do hash perceptual, na ordem de schema.PHASH_BAND_EXPRESSIONS."""
+    unsigned = phash & 0xFFFFFFFFFFFFFFFF
+    return [(unsigned >> (schema.PHASH_BAND_BITS * band)) & 0xFFFF for band in range(len(schema.PHASH_BAND_EXPRESSIONS))]
+
+
+def _band_neighbours(band: int, radius: int):
+    """Todos os valores de 16 bits a até `radius` bits de `band`."""
+    values = [band]
+    for flipped in range(1, radius + 1):
+        for bits in combinations(range(schema.PHASH_BAND_BITS), flipped):
+            mask = 0
+            for bit in bits:
+                mask |= 1 << bit
+            values.append(band ^ mask)
+    return values
+
+
+async def find_near_duplicates(pool, phash: int, max_distance: int = PHASH_MAX_DISTANCE, limit: int = 20,
+                               exclude_content_hash: str = None):
+    """
+    Lista os pins cuja imagem tem hash perceptual a até `max_distance` bits de `phash`,
+    do mais parecido para o menos, deixando de fora os de `exclude_content_hash` (a
+    própria imagem).
+
+    Se dois hashes diferem em até `max_distance` bits, pelo menos uma das 4 faixas de 16
+    bits difere em até max_distance // 4 bits. A consulta pega pelos índices das faixas
+    só os candidatos com alguma faixa nesse raio e confere a distância completa neles,
+    sem varrer a tabela. Com o padrão de 6 bits, são 17 valores por faixa.
+    """
+    radius = max_distance // len(schema.PHASH_BAND_EXPRESSIONS)
+    neighbours = [_band_neighbours(band, radius) for band in phash_bands(phash)]
+    band_filter = " OR ".join(
+        f"{expression} = ANY(${index + 2}::integer[])" for index, expression in enumerate(schema.PHASH_BAND_EXPRESSIONS)
+    )
+    async with pool.acquire() as conn:
+        return await conn.fetch(
+            f"""
+            SELECT pinterest_id, content_hash, local_path, bit_count((phash # $1)::bit(64)) AS distance
+            FROM images
+            WHERE phash IS NOT NULL AND ({band_filter}) AND bit_count((phash # $1)::bit(64)) <= $6
+              AND content_hash IS DISTINCT FROM $8
+            ORDER BY distance
+            LIMIT $7;
+            """,
+            phash, *neighbours, max_distance, limit, exclude_content_hash
+        )
+
+
+class SeenPinIndex:
+    """
+    Índice compacto dos pinterest_id já armazenados.
+
+    Os IDs numéricos ficam num array int64 ordenado (8 bytes por pin, busca
+    binária); os adicionados durante a execução ficam num set pequeno que é
+    incorporado ao array quando cresce. IDs não numéricos, se aparecerem, vão
+    para um set à parte. As cargas do banco leem `pin_ids` em ordem de inserção
+    (`seq`, numerado pelo servidor), acumulam num array e ordenam uma única vez.
+    Nas atualizações, só os IDs que ainda não estão no array são intercalados nele,
+    copiando os trechos entre eles, sem reordenar o array inteiro.
+    """
+
+    def __init__(self, merge_threshold: int = 4096):
+        self.merge_threshold = merge_threshold
+        self._ids = array("q")
+        self._recent = set()
+        self._other = set()
+        self._last_seq = None
+
+    def __len__(self):
+        return len(self._ids) + len(self._recent) + len(self._other)
+
+    def __contains__(self, pinterest_id) -> bool:
+        try:
+            value = int(pinterest_id)
+        except (TypeError, ValueError):
+            return pinterest_id in self._other
+        return value in self._recent or self._in_array(value)
+
+    def _in_array(self, value: int) -> bool:
+        position = bisect_left(self._ids, value)
+        return position < len(self._ids) and self._ids[position] == value
+
+    def add(self, pinterest_id):
+        try:
+            value = int(pinterest_id)
+        except (TypeError, ValueError):
+            self._other.add(pinterest_id)
+            return
+        self._recent.add(value)
+        if len(self._recent) >= self.merge_threshold:
+            self._merge()
+
+    def _merge(self, loaded=()):
+        if not self._ids:
+            self._ids = array("q", sorted(set(chain(loaded, self._recent))))
+            self._recent.clear()
+            return
+        new_ids = sorted({value for value in chain(loaded, self._recent) if not self._in_array(value)})
+        self._recent.clear()
+        if not new_ids:
+            return
+        merged = array("q")
+        start = 0
+        for value in new_ids:
+            position = bisect_left(self._ids, value, start)
+            merged.extend(self._ids[start:position])
+            merged.append(value)
+            start = position
+        merged.extend(self._ids[start:])
+        self._ids = merged
+
+    async def load(self, pool):
+        """Carrega todos os IDs de `pin_ids`. Retorna quantos foram lidos."""
+        self._ids = array("q")
+        self._recent.clear()
+        self._other.clear()
+        self._last_seq = None
+        loaded = await self._load_since(pool, None)
+        print(f"Índice de pins conhecidos carregado: {loaded} pins.")
+        return loaded
+
+    async def refresh(self, pool):
+        """Lê só os pins que entraram em `pin_ids` depois da última carga. Retorna quantos foram lidos."""
+        since = None if self._last_seq is None else self._last_seq - SEEN_INDEX_REFRESH_OVERLAP
+        return await self._load_since(pool, since)
+
+    async def refresh_periodically(self, pool, interval: float = SEEN_INDEX_REFRESH_INTERVAL):
+        """Atualiza o índice a cada `interval` segundos (para rodar como tarefa de fundo)."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh(pool)
+            except Exception as e:
+                print(f"Erro ao atualizar o índice de pins conhecidos: {e}")
+
+    async def _load_since(self, pool, since):
+        loaded = array("q")
+        count = 0
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                if since is None:
+                    cursor = conn.cursor("SELECT pinterest_id, seq FROM pin_ids")
+                else:
+                    cursor = conn.cursor("SELECT pinterest_id, seq FROM pin_ids WHERE seq > $1", since)
+                async for record in cursor:
+                    try:
+                        loaded.append(int(record["pinterest_id"]))
+                    except (TypeError, ValueError):
+                        self._other.add(record["pinterest_id"])
+                    if self._last_seq is None or record["seq"] > self._last_seq:
+                        self._last_seq = record["seq"]
+                    count += 1
+        self._merge(loaded)
+        return count
+
+
+def _pin_from_spool(record: dict) -> dict:
+    """Restaura os tipos que o JSON do spool transformou em texto (collected_at)."""
+    collected_at = record.get("collected_at")
+    if isinstance(collected_at, str):
+        record["collected_at"] = datetime.fromisoformat(collected_at)
+    return record
+
+
+async def ingest_from_spool(source: str = "fetch", batch_size: int = SPOOL_BATCH_SIZE):
+    """
+    Etapa `ingest`: grava no banco, em lotes com COPY, os pins do spool `source`.
+
+    O checkpoint só avança depois que o lote entrou no banco. Se uma gravação falhar,
+    a ingestão para e a próxima execução recomeça do mesmo lote, sem perder pins.
+    Retorna quantos pins foram gravados (novos ou duplicados).
+    """
+    pool = await create_db_pool()
+    if not pool:
+        print("Não foi possível estabelecer conexão com o banco de dados. O spool fica para a próxima execução.")
+        return 0
+
+    replayed = 0
+    try:
+        await schema.migrate(pool)
+        reader = SpoolReader(source, "ingest")
+        ingestor = ImageIngestor(pool, batch_size=batch_size)
+        for records, position in reader.batches(batch_size):
+            failed = ingestor.failed_total
+            for record in records:
+                await ingestor.add(_pin_from_spool(record))
+            await ingestor.flush()
+            if ingestor.failed_total > failed:
+                print("Ingestão interrompida; o lote continua no spool e será regravado na próxima execução.")
+                break
+            reader.commit(position)
+            replayed += len(records)
+        print(f"--- Ingestão encerrada: {replayed} pins do spool '{source}' "
+              f"({ingestor.inserted_total} novos, {ingestor.updated_total} completados com a imagem, "
+              f"{ingestor.duplicate_total} duplicados; "
+              f"{reader.pending_bytes()} bytes pendentes) ---")
+    except asyncpg.exceptions.PostgresError as e:
+        print(f"Erro ao aplicar as migrações do banco de dados: {e}")
+    finally:
+        await pool.close()
+    return replayed
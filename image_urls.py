@@ -0,0 +1,90 @@
+"""
+Escolha da resolução das imagens do i.pinimg.com a partir do src/srcset e das variantes da API.
+
+Só usa a biblioteca padrão: serve tanto ao crawler quanto aos downloads.
+"""
+import os
+import re
+
+import settings  # noqa: F401  Carrega o .env antes de ler as configurações
+
+# Resolução baixada do i.pinimg.com: "236x", "474x", "736x" ou "originals". O padrão é a
+# 236x que o feed renderiza; baixar maior é opcional, pelo .env. Se a variante escolhida
+# não existir, o download tenta as menores e depois as maiores. As funções leem o valor
+# na hora da chamada, então quem muda IMAGE_TARGET_RESOLUTION em tempo de execução (o
+# benchmark, por exemplo) não precisa passar `target` a cada uma.
+PINIMG_SIZES = ("236x", "474x", "736x", "originals")
+IMAGE_TARGET_RESOLUTION = os.getenv("IMAGE_TARGET_RESOLUTION", PINIMG_SIZES[0])
+# Segmento de tamanho das URLs de imagem do Pinterest: /<tamanho>/ab/cd/ef/<hash>.<ext>
+PINIMG_SIZE_PATTERN = re.compile(r'/(\d+x|originals)/(?=[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{2}/)')
+
+
+def parse_srcset(srcset):
+    """Converte um atributo srcset em [(url, descritor)], com o descritor numérico ("2x" -> 2.0, "474w" -> 474.0)."""
+    candidates = []
+    for entry in (srcset or "").split(","):
+        parts = entry.split()
+        if not parts:
+            continue
+        descriptor = 1.0
+        if len(parts) > 1:
+            try:
+                descriptor = float(parts[1].rstrip("xw"))
+            except ValueError:
+                pass
+        candidates.append((parts[0], descriptor))
+    return candidates
+
+
+def pinimg_variant(image_url: str, size: str) -> str:
+    """Troca o segmento de tamanho de uma URL do i.pinimg.com (/236x/ -> /736x/, /originals/...)."""
+    return PINIMG_SIZE_PATTERN.sub(f"/{size}/", image_url, count=1)
+
+
+def image_size_fallbacks(target: str = None):
+    """Ordem de tentativa dos tamanhos: o alvo, os menores do maior para o menor e, por fim, os maiores."""
+    target = target or IMAGE_TARGET_RESOLUTION
+    if target not in PINIMG_SIZES:
+        target = PINIMG_SIZES[0]
+    position = PINIMG_SIZES.index(target)
+    return (target,) + PINIMG_SIZES[:position][::-1] + PINIMG_SIZES[position + 1:]
+
+
+def select_image_url(src, srcset=None, target: str = None):
+    """
+    Escolhe a URL da imagem de um <img> na resolução alvo.
+
+    Procura uma URL do i.pinimg.com no src ou no srcset e reescreve o tamanho para
+    `target` (IMAGE_TARGET_RESOLUTION por padrão). Fora do i.pinimg.com fica com o maior candidato do srcset. Um data: URI
+    só é devolvido quando não há nenhuma URL real.
+    """
+    candidates = [url for url, _ in sorted(parse_srcset(srcset), key=lambda item: -item[1])]
+    if src:
+        candidates.append(src)
+    real_urls = [url for url in candidates if not url.startswith("data:")]
+    for url in real_urls:
+        if PINIMG_SIZE_PATTERN.search(url):
+            return pinimg_variant(url, target or IMAGE_TARGET_RESOLUTION)
+    if real_urls:
+        return real_urls[0]
+    return src
+
+
+def image_url_candidates(pin_data: dict, target: str = None):
+    """URLs a tentar, em ordem, para baixar a imagem de um pin: a resolução alvo e depois as alternativas."""
+    image_url = pin_data.get("image_url")
+    variants = pin_data.get("image_variants")
+    if variants:
+        urls = [variants[size]["url"] for size in resource_size_keys(target) if size in variants]
+    elif image_url and PINIMG_SIZE_PATTERN.search(image_url):
+        urls = [pinimg_variant(image_url, size) for size in image_size_fallbacks(target)]
+    else:
+        urls = []
+    if image_url:
+        urls.insert(0, image_url)
+    return list(dict.fromkeys(urls))
+
+
+def resource_size_keys(target: str = None):
+    """Os mesmos tamanhos de image_size_fallbacks com os nomes usados na API ("originals" vira "orig")."""
+    return ["orig" if size == "originals" else size for size in image_size_fallbacks(target)]
@@ -0,0 +1,456 @@
+"""
+Fila de jobs no próprio Postgres para distribuir download e categorização entre processos.
+
+O crawler grava os pins no banco e enfileira um job de download por pin; qualquer número
+de workers, em qualquer máquina que alcance o banco, reserva jobs em lotes com
+`FOR UPDATE SKIP LOCKED` (dois workers nunca pegam o mesmo job e ninguém espera pelo
+lock do outro). Cada reserva vale por um tempo (lease): se o worker morrer, o job volta
+a ficar visível quando o lease vencer. Falhas são tentadas de novo com espera crescente
+até `max_attempts`, depois o job fica como "failed" com o último erro.
+
+Uso:
+    python job_queue.py init                                # aplica as migrações (inclui a tabela de jobs)
+    python job_queue.py worker download --processes 4      # 4 processos de download nesta máquina
+    python job_queue.py worker categorize                   # categorização (requer categorizer.py)
+    python job_queue.py stats                               # jobs por tipo e estado
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import time
+from datetime import datetime
+
+import metrics
+import schema
+from database import ImageIngestor, create_db_pool
+from image_urls import image_url_candidates
+from settings import IMAGE_STORAGE_FIELDS, METRICS_OUTPUT
+from storage import ImageDownloader
+
+JOB_KINDS = ("download", "categorize")
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 300))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", 30))  # Segundos antes da 2ª tentativa; dobra a cada falha
+JOB_CLAIM_BATCH = int(os.getenv("JOB_CLAIM_BATCH", 32))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 2.0))
+JOB_ENQUEUE_BATCH = int(os.getenv("JOB_ENQUEUE_BATCH", 200))
+# O worker de download enfileira a categorização de cada imagem nova
+ENQUEUE_CATEGORIZE = os.getenv("ENQUEUE_CATEGORIZE", "1") == "1"
+
+
+class JobQueue:
+    """Operações da fila sobre a tabela `jobs`, identificando este processo como `worker_id`."""
+
+    def __init__(self, pool, worker_id: str = None):
+        self.pool = pool
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+
+    async def enqueue_many(self, kind: str, payloads, dedupe_keys=None, max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+        """Enfileira vários jobs de uma vez. Jobs com `dedupe_key` já existente são ignorados. Retorna os novos."""
+        payloads = list(payloads)
+        if not payloads:
+            return 0
+        dedupe_keys = list(dedupe_keys) if dedupe_keys is not None else [None] * len(payloads)
+        async with self.pool.acquire() as conn:
+            status = await conn.execute(
+                """
+                INSERT INTO jobs (kind, payload, dedupe_key, max_attempts)
+                SELECT $1, payload::jsonb, dedupe_key, $4
+                FROM unnest($2::text[], $3::text[]) AS batch (payload, dedupe_key)
+                ON CONFLICT (dedupe_key) DO NOTHING;
+                """,
+                kind, [json.dumps(payload, default=str) for payload in payloads], dedupe_keys, max_attempts
+            )
+        enqueued = int(status.split()[-1])
+        metrics.counter(f"jobs.{kind}.enqueued").inc(enqueued)
+        return enqueued
+
+    async def claim(self, kind: str, limit: int = JOB_CLAIM_BATCH, lease_seconds: float = JOB_LEASE_SECONDS):
+        """
+        Reserva até `limit` jobs disponíveis: pendentes já liberados ou em execução com o
+        lease vencido (worker que morreu). Retorna [{id, payload, attempts, max_attempts}].
+        """
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                WITH claimable AS (
+                    SELECT id FROM jobs
+                    WHERE kind = $1
+                      AND ((status = 'pending' AND available_at <= now())
+                           OR (status = 'running' AND locked_until < now()))
+                    ORDER BY available_at, id
+                    LIMIT $2
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE jobs
+                SET status = 'running', locked_by = $3, attempts = jobs.attempts + 1,
+                    locked_until = now() + make_interval(secs => $4), updated_at = now()
+                FROM claimable
+                WHERE jobs.id = claimable.id
+                RETURNING jobs.id, jobs.payload, jobs.attempts, jobs.max_attempts;
+                """,
+                kind, limit, self.worker_id, lease_seconds
+            )
+        metrics.counter(f"jobs.{kind}.claimed").inc(len(rows))
+        return [
+            {"id": row["id"], "payload": json.loads(row["payload"]), "attempts": row["attempts"],
+             "max_attempts": row["max_attempts"]}
+            for row in rows
+        ]
+
+    async def extend(self, job_ids, lease_seconds: float = JOB_LEASE_SECONDS):
+        """Renova o lease dos jobs que este worker ainda está processando."""
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE jobs SET locked_until = now() + make_interval(secs => $3) "
+                "WHERE id = ANY($1::bigint[]) AND locked_by = $2 AND status = 'running';",
+                list(job_ids), self.worker_id, lease_seconds
+            )
+
+    async def complete(self, kind: str, job_ids):
+        """Marca os jobs como concluídos (se o lease ainda for deste worker)."""
+        if not job_ids:
+            return
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE jobs SET status = 'done', locked_by = NULL, locked_until = NULL, last_error = NULL, "
+                "updated_at = now() WHERE id = ANY($1::bigint[]) AND locked_by = $2;",
+                list(job_ids), self.worker_id
+            )
+        metrics.counter(f"jobs.{kind}.done").inc(len(job_ids))
+
+    async def fail(self, kind: str, failures):
+        """
+        Registra falhas [(job, erro)]: o job volta para a fila com espera exponencial ou,
+        esgotadas as tentativas, fica como "failed".
+        """
+        if not failures:
+            return
+        retry = [(job["id"], error, JOB_RETRY_BACKOFF * 2 ** (job["attempts"] - 1))
+                 for job, error in failures if job["attempts"] < job["max_attempts"]]
+        dead = [(job["id"], error) for job, error in failures if job["attempts"] >= job["max_attempts"]]
+        async with self.pool.acquire() as conn:
+            if retry:
+                await conn.executemany(
+                    "UPDATE jobs SET status = 'pending', locked_by = NULL, locked_until = NULL, last_error = $3, "
+                    "available_at = now() + make_interval(secs => $4), updated_at = now() "
+                    "WHERE id = $1 AND locked_by = $2;",
+                    [(job_id, self.worker_id, error, delay) for job_id, error, delay in retry]
+                )
+            if dead:
+                await conn.executemany(
+                    "UPDATE jobs SET status = 'failed', locked_by = NULL, locked_until = NULL, last_error = $3, "
+                    "updated_at = now() WHERE id = $1 AND locked_by = $2;",
+                    [(job_id, self.worker_id, error) for job_id, error in dead]
+                )
+        metrics.counter(f"jobs.{kind}.retried").inc(len(retry))
+        metrics.counter(f"jobs.{kind}.failed").inc(len(dead))
+
+    async def fail_expired(self):
+        """Encerra como "failed" os jobs cujo lease venceu na última tentativa (worker morreu em todas)."""
+        async with self.pool.acquire() as conn:
+            status = await conn.execute(
+                "UPDATE jobs SET status = 'failed', locked_by = NULL, last_error = 'lease vencido na última tentativa', "
+                "updated_at = now() WHERE status = 'running' AND locked_until < now() AND attempts >= max_attempts;"
+            )
+        return int(status.split()[-1])
+
+    async def stats(self):
+        """Contagem de jobs por tipo e estado: {(kind, status): n}."""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("SELECT kind, status, count(*) AS total FROM jobs GROUP BY kind, status;")
+        return {(row["kind"], row["status"]): row["total"] for row in rows}
+
+
+class QueueingPipeline:
+    """
+    Substituto do CrawlPipeline para o modo distribuído: em vez de baixar no próprio
+    processo, grava os pins no banco e enfileira um job de download por pin.
+
+    Os pins são gravados (ImageIngestor) antes de os jobs do lote serem enfileirados,
+    então um worker sempre encontra a linha do pin que vai atualizar.
+    """
+
+    def __init__(self, ingestor: ImageIngestor, queue: JobQueue, batch_size: int = JOB_ENQUEUE_BATCH):
+        self.ingestor = ingestor
+        self.queue = queue
+        self.batch_size = batch_size
+        self.collected = 0
+        self.enqueued = 0
+        self._pending = []
+        self._lock = asyncio.Lock()
+
+    def start(self):
+        pass
+
+    async def feed(self, pins):
+        """Consome um iterável assíncrono de pins, gravando-os e enfileirando os downloads. Retorna quantos foram."""
+        fed = 0
+        async for pin_data in pins:
+            await self.ingestor.add(pin_data)
+            self._pending.append(pin_data)
+            self.collected += 1
+            fed += 1
+            if len(self._pending) >= self.batch_size:
+                await self._enqueue_pending()
+        return fed
+
+    async def _enqueue_pending(self):
+        async with self._lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            await self.ingestor.flush()
+            self.enqueued += await self.queue.enqueue_many(
+                "download",
+                [{**pin_data, "image_urls": image_url_candidates(pin_data)} for pin_data in batch],
+                [f"download:{pin_data['pinterest_id']}" for pin_data in batch]
+            )
+
+    async def drain(self):
+        await self._enqueue_pending()
+
+    async def close(self):
+        await self._enqueue_pending()
+
+
+class DownloadHandler:
+    """Baixa as imagens de um lote de jobs e atualiza as linhas dos pins em `images`."""
+
+    def __init__(self, queue: JobQueue, downloader: ImageDownloader):
+        self.queue = queue
+        self.downloader = downloader
+
+    async def __call__(self, jobs):
+        results = await asyncio.gather(*(
+            self.downloader.download(job["payload"]["image_urls"][0], job["payload"]["image_urls"][1:])
+            for job in jobs
+        ))
+        stored = [(job, result) for job, result in zip(jobs, results) if result["status"] != "failed"]
+        failures = [(job, f"download falhou: {result['image_url']}")
+                    for job, result in zip(jobs, results) if result["status"] == "failed"]
+
+        if stored:
+            # Upsert: mesmo que a gravação do crawler tenha falhado, o pin chega ao banco com a imagem.
+            # Se o ID entra agora em `pin_ids` a linha é inserida; senão, a linha existente é atualizada.
+            async with self.queue.pool.acquire() as conn:
+                await conn.executemany(
+                    """
+                    WITH new_id AS (
+                        INSERT INTO pin_ids (pinterest_id) VALUES ($1)
+                        ON CONFLICT (pinterest_id) DO NOTHING
+                        RETURNING pinterest_id
+                    ), updated AS (
+                        UPDATE images SET image_url = $4, local_path = $8, content_hash = $9, mime_type = $10,
+                                          width = $11, height = $12, file_size = $13, phash = $14
+                        WHERE pinterest_id = $1 AND NOT EXISTS (SELECT 1 FROM new_id)
+                    )
+                    INSERT INTO images (pinterest_id, title, description, image_url, board_url, pin_url, collected_at,
+                                        local_path, content_hash, mime_type, width, height, file_size, phash)
+                    SELECT $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14
+                    WHERE EXISTS (SELECT 1 FROM new_id);
+                    """,
+                    [
+                        (job["payload"]["pinterest_id"], job["payload"].get("title"),
+                         job["payload"].get("description"), result["image_url"], job["payload"].get("board_url"),
+                         job["payload"].get("pin_url"), _parse_timestamp(job["payload"].get("collected_at")),
+                         result["path"], *(result[field] for field in IMAGE_STORAGE_FIELDS))
+                        for job, result in stored
+                    ]
+                )
+            if ENQUEUE_CATEGORIZE:
+                hashes = list(dict.fromkeys(result["content_hash"] for _, result in stored))
+                await self.queue.enqueue_many("categorize", [{"content_hash": h} for h in hashes],
+                                              [f"categorize:{h}" for h in hashes])
+        return [job["id"] for job, _ in stored], failures
+
+
+class CategorizeHandler:
+    """Categoriza as imagens de um lote de jobs reaproveitando o cache por content_hash do categorizer."""
+
+    def __init__(self, queue: JobQueue):
+        from concurrent.futures import ProcessPoolExecutor
+
+        import categorizer
+
+        self.queue = queue
+        self.categorizer = categorizer
+        self.model = categorizer.ClipCategorizer()
+        self.executor = ProcessPoolExecutor(max_workers=categorizer.CATEGORIZE_WORKERS)
+
+    async def __call__(self, jobs):
+        hashes = [job["payload"]["content_hash"] for job in jobs]
+        cached = await self.categorizer.apply_cached(self.queue.pool, hashes)
+        cached |= await self.categorizer.apply_near_duplicates(
+            self.queue.pool, [content_hash for content_hash in hashes if content_hash not in cached])
+        async with self.queue.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT DISTINCT ON (content_hash) content_hash, local_path FROM images "
+                "WHERE content_hash = ANY($1::text[]) AND local_path IS NOT NULL;",
+                [content_hash for content_hash in hashes if content_hash not in cached]
+            )
+        paths = {row["content_hash"]: row["local_path"] for row in rows}
+        pending = list(paths.items())
+
+        results = []
+        if pending:
+            batch, valid = await self.categorizer.preprocess_batch(self.executor, [path for _, path in pending])
+            if batch is not None:
+                predictions = await asyncio.to_thread(self.model.categorize, batch)
+                results = [(pending[index][0], *prediction) for index, prediction in zip(valid, predictions)]
+            unreadable = [(pending[index][0], self.categorizer.UNREADABLE_CATEGORY, None, None)
+                          for index in sorted(set(range(len(pending))) - set(valid))]
+            await self.categorizer.store_results(self.queue.pool, results + unreadable, self.model.model_id)
+
+        done = [job["id"] for job in jobs if job["payload"]["content_hash"] in cached or
+                job["payload"]["content_hash"] in paths]
+        failures = [(job, "imagem não encontrada no armazenamento local") for job in jobs
+                    if job["id"] not in set(done)]
+        return done, failures
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def _parse_timestamp(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+async def _keep_leases(queue: JobQueue, job_ids, lease_seconds: float):
+    """Renova o lease dos jobs em andamento a cada terço do lease."""
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        await queue.extend(job_ids, lease_seconds)
+
+
+async def run_worker(kind: str, batch_size: int = JOB_CLAIM_BATCH, lease_seconds: float = JOB_LEASE_SECONDS,
+                     max_jobs: int = None, exit_when_empty: bool = False, metrics_output: str = METRICS_OUTPUT):
+    """
+    Reserva e processa lotes de jobs de `kind` até ser interrompido (ou até a fila esvaziar).
+    Ao sair grava o resumo das métricas deste processo em `metrics_output`.
+    """
+    pool = await create_db_pool()
+    if not pool:
+        print("Não foi possível estabelecer conexão com o banco de dados. Encerrando.")
+        return
+    queue = JobQueue(pool)
+    downloader = None
+    handler = None
+    processed = 0
+    started = time.perf_counter()
+    last_report = started
+    try:
+        await schema.migrate(pool)
+        if kind == "download":
+            downloader = ImageDownloader()
+            await downloader.open()
+            handler = DownloadHandler(queue, downloader)
+        else:
+            handler = CategorizeHandler(queue)
+        print(f"Worker {queue.worker_id} processando jobs de {kind} (lotes de {batch_size}).")
+
+        while max_jobs is None or processed < max_jobs:
+            await queue.fail_expired()
+            jobs = await queue.claim(kind, batch_size, lease_seconds)
+            if not jobs:
+                if exit_when_empty:
+                    break
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+
+            lease_keeper = asyncio.create_task(_keep_leases(queue, [job["id"] for job in jobs], lease_seconds))
+            try:
+                with metrics.timer(f"jobs.{kind}.batch.seconds"):
+                    done, failures = await handler(jobs)
+            except Exception as e:
+                done, failures = [], [(job, f"{type(e).__name__}: {e}") for job in jobs]
+                print(f"Erro ao processar lote de {len(jobs)} jobs de {kind}: {e}")
+            finally:
+                lease_keeper.cancel()
+            await queue.complete(kind, done)
+            await queue.fail(kind, failures)
+            processed += len(jobs)
+
+            now = time.perf_counter()
+            if now - last_report >= 10:
+                rate = processed / (now - started)
+                metrics.gauge(f"jobs.{kind}.per_second").set(round(rate, 2))
+                print(f"[{queue.worker_id}] {processed} jobs de {kind} processados ({rate:.1f} jobs/s).")
+                last_report = now
+    finally:
+        if downloader:
+            await downloader.close()
+        if isinstance(handler, CategorizeHandler):
+            handler.close()
+        await pool.close()
+        elapsed = time.perf_counter() - started
+        print(f"[{queue.worker_id}] Encerrado: {processed} jobs de {kind} em {elapsed:.1f}s "
+              f"({processed / elapsed if elapsed else 0:.1f} jobs/s).")
+        metrics.REGISTRY.write_json(metrics_output)
+
+
+async def _init():
+    pool = await create_db_pool()
+    if not pool:
+        return
+    try:
+        await schema.migrate(pool)
+        print("Tabela de jobs pronta.")
+    finally:
+        await pool.close()
+
+
+async def _print_stats():
+    pool = await create_db_pool()
+    if not pool:
+        return
+    try:
+        counts = await JobQueue(pool).stats()
+    finally:
+        await pool.close()
+    for (kind, status), total in sorted(counts.items()):
+        print(f"{kind:12} {status:8} {total}")
+
+
+def _worker_process(args):
+    metrics_output = METRICS_OUTPUT
+    if args.processes > 1 and metrics_output:
+        # Um resumo por processo (metrics.json -> metrics.<pid>.json), senão o último sobrescreve os outros
+        root, extension = os.path.splitext(metrics_output)
+        metrics_output = f"{root}.{os.getpid()}{extension}"
+    asyncio.run(run_worker(args.kind, args.batch, args.lease, args.max_jobs, args.exit_when_empty, metrics_output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fila de jobs distribuída no Postgres.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("init", help="aplica as migrações do banco, incluindo a tabela de jobs")
+    commands.add_parser("stats", help="mostra os jobs por tipo e estado")
+    worker = commands.add_parser("worker", help="processa jobs de um tipo")
+    worker.add_argument("kind", choices=JOB_KINDS)
+    worker.add_argument("--processes", type=int, default=1, help="quantos processos de worker iniciar nesta máquina")
+    worker.add_argument("--batch", type=int, default=JOB_CLAIM_BATCH, help="jobs reservados por vez")
+    worker.add_argument("--lease", type=float, default=JOB_LEASE_SECONDS, help="duração do lease em segundos")
+    worker.add_argument("--max-jobs", type=int, help="encerra depois de processar esta quantidade")
+    worker.add_argument("--exit-when-empty", action="store_true", help="encerra quando não houver jobs disponíveis")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        asyncio.run(_init())
+    elif args.command == "stats":
+        asyncio.run(_print_stats())
+    elif args.processes > 1:
+        processes = [multiprocessing.Process(target=_worker_process, args=(args,)) for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        _worker_process(args)
+
+
+if __name__ == "__main__":
+    main()
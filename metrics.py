@@ -0,0 +1,183 @@
+"""
+Métricas por etapa do scraper: contadores, gauges, histogramas e timers em memória.
+
+Tudo é registrado no REGISTRY global e pode ser exportado como um resumo JSON no fim
+da execução, servido ao vivo por HTTP (serve_metrics) ou combinado com um profiler
+por amostragem (profile_run).
+"""
+import json
+import random
+import time
+from contextlib import contextmanager
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def summary(self):
+        return self.value
+
+
+class Gauge:
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def summary(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Guarda contagem, soma, mínimo e máximo exatos e uma amostra de tamanho fixo
+    (reservoir sampling) para estimar os percentis sem crescer com a execução.
+    """
+
+    def __init__(self, reservoir_size: int = 4096):
+        self.reservoir_size = reservoir_size
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._samples = []
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._samples) < self.reservoir_size:
+            self._samples.append(value)
+        else:
+            position = random.randrange(self.count)
+            if position < self.reservoir_size:
+                self._samples[position] = value
+
+    def percentile(self, fraction):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "min": self.min,
+            "max": self.max,
+            "mean": round(self.total / self.count, 6) if self.count else None,
+            "p50": self.percentile(0.50),
+            "p90": self.percentile(0.90),
+            "p99": self.percentile(0.99)
+        }
+
+
+class MetricsRegistry:
+    """Cria as métricas sob demanda pelo nome e gera o resumo da execução."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._metrics = {}
+
+    def _get(self, name, kind):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = kind()
+        return metric
+
+    def counter(self, name) -> Counter:
+        return self._get(name, Counter)
+
+    def gauge(self, name) -> Gauge:
+        return self._get(name, Gauge)
+
+    def histogram(self, name) -> Histogram:
+        return self._get(name, Histogram)
+
+    @contextmanager
+    def timer(self, name):
+        """Mede a duração do bloco em segundos no histograma `name`."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histogram(name).observe(time.perf_counter() - started)
+
+    def summary(self) -> dict:
+        return {
+            "started_at": self.started_at,
+            "elapsed_seconds": round(time.time() - self.started_at, 3),
+            "metrics": {name: metric.summary() for name, metric in sorted(self._metrics.items())}
+        }
+
+    def write_json(self, path=None):
+        """Grava o resumo em `path`, ou imprime na saída padrão se não houver caminho."""
+        output = json.dumps(self.summary(), indent=2, default=str)
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(output)
+            print(f"Resumo de métricas gravado em {path}.")
+        else:
+            print(output)
+
+
+REGISTRY = MetricsRegistry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+timer = REGISTRY.timer
+
+
+async def serve_metrics(port: int, registry: MetricsRegistry = REGISTRY):
+    """Sobe um endpoint HTTP local (GET /metrics) com o resumo ao vivo. Retorna o runner para encerrar."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.json_response(registry.summary(), dumps=lambda data: json.dumps(data, default=str))
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    print(f"Métricas ao vivo em http://127.0.0.1:{port}/metrics")
+    return runner
+
+
+def profile_run(function, output_path: str):
+    """
+    Executa `function()` sob um profiler por amostragem e grava o resultado em `output_path`.
+
+    Usa o pyinstrument (relatório HTML) quando ele está instalado; sem ele, cai para o
+    cProfile da biblioteca padrão (arquivo .pstats), que é determinístico e mais caro.
+    """
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        Profiler = None
+
+    if Profiler is not None:
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        try:
+            return function()
+        finally:
+            profiler.stop()
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.write(profiler.output_html())
+            print(f"Perfil de execução (pyinstrument) gravado em {output_path}.")
+
+    import cProfile
+    print("pyinstrument não está instalado; usando cProfile.")
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function)
+    finally:
+        profiler.dump_stats(output_path)
+        print(f"Perfil de execução (cProfile) gravado em {output_path}.")
@@ -1,121 +1,138 @@
 import asyncio
+import json
 import os
-import random
 import re
 import sys
+import time
+from collections import deque
 from datetime import datetime
-import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit
 
 import asyncpg
-from dotenv import load_dotenv
-from playwright.async_api import async_playwright, Page, TimeoutError as PlaywrightTimeoutError
+from playwright.async_api import async_playwright, Error as PlaywrightError, Page, TimeoutError as PlaywrightTimeoutError
 
-# Carrega as variáveis de ambiente do arquivo .env
-load_dotenv()
-
-# Configurações do Banco de Dados
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_PORT = os.getenv("DB_PORT", "5432")
-DB_NAME = os.getenv("DB_NAME", "pinterest_images")
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
+import metrics
+import rate_limiter
+import schema
+import spool
+from database import ImageIngestor, SeenPinIndex, create_db_pool
+from image_urls import resource_size_keys, select_image_url
+from settings import METRICS_OUTPUT, METRICS_PORT, PROFILE_OUTPUT, USER_AGENT
 
 # Configurações do Pinterest e Scraping
 PINTEREST_EMAIL = os.getenv("PINTEREST_EMAIL")
 PINTEREST_PASSWORD = os.getenv("PINTEREST_PASSWORD")
 BOARD_URL = os.getenv("BOARD_URL", "https://br.pinterest.com/feed/")
 MAX_IMAGES_TO_COLLECT = int(os.getenv("MAX_IMAGES_TO_COLLECT", 100))
-IMAGE_SAVE_DIR = "IMAGENS"
-
-# Configurações de Robustez
+# Modo de extração dos pins: "batch" (um page.evaluate por rolagem), "element" (chamadas por pin)
+# ou "network" (lê os pins das respostas JSON do feed, sem tocar no DOM)
+COLLECTOR_MODE = os.getenv("COLLECTOR_MODE", "batch")
+
+# Tamanho das filas entre coleta, download e banco (limita a memória e aplica contrapressão)
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 200))
+# Modo distribuído: o crawler só grava os pins e enfileira jobs de download na tabela `jobs`,
+# processados por `python job_queue.py worker download` em qualquer máquina
+JOB_QUEUE = os.getenv("JOB_QUEUE", "0") == "1"
+
+# Coleta longa: memória e custo por rolagem constantes em execuções de 100k+ pins.
+# Remove do DOM os pins já lidos e troca a página ao passar dos limites abaixo (0 desativa).
+LONG_CRAWL = os.getenv("LONG_CRAWL", "0") == "1"
+RECYCLE_AFTER_PINS = int(os.getenv("RECYCLE_AFTER_PINS", 5000))
+RECYCLE_HEAP_MB = int(os.getenv("RECYCLE_HEAP_MB", 512))
+RECYCLE_CHECK_EVERY = 100  # De quantos em quantos pins o heap JS é consultado
+
+# Configurações de Robustez (o ritmo das navegações, rolagens e downloads vem do rate_limiter)
 SCROLL_PAUSE_TIME = 2
-RANDOM_DELAY_MIN = 1.5
-RANDOM_DELAY_MAX = 3.5
+# "adaptive" rola de novo assim que pins novos aparecem (com intervalo mínimo entre rolagens);
+# "fixed" usa as pausas fixas e compara a altura da página
+SCROLL_MODE = os.getenv("SCROLL_MODE", "adaptive")
+SCROLL_MIN_INTERVAL = float(os.getenv("SCROLL_MIN_INTERVAL", 1.0))
+SCROLL_IDLE_TIMEOUT = float(os.getenv("SCROLL_IDLE_TIMEOUT", 8.0))
+SCROLL_MAX_IDLE = int(os.getenv("SCROLL_MAX_IDLE", 3))
+# Rolagens sem nenhum pin novo permitidas por alvo, somadas entre as páginas recicladas
+SCROLL_MAX_EMPTY = int(os.getenv("SCROLL_MAX_EMPTY", 200))
 VIEWPORT_WIDTH = 1280
 VIEWPORT_HEIGHT = 900
-USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
-
-# Variável global para armazenar o loop do banco de dados e a conexão
-_db_loop: asyncio.BaseEventLoop = None
-_db_conn: asyncpg.Connection = None
 
-
-def _run_db_loop():
-    """Função para ser executada em um thread separado para o loop do DB."""
-    global _db_loop
-    _db_loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(_db_loop)
-    _db_loop.run_forever()
-
-
-async def connect_to_db_in_thread():
-    """Conecta ao banco de dados dentro do thread do loop do DB."""
-    global _db_conn
-    try:
-        _db_conn = await asyncpg.connect(
-            host=DB_HOST,
-            port=int(DB_PORT),
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        print("Conexão com o banco de dados PostgreSQL estabelecida com sucesso!")
-        return _db_conn
-    except Exception as e:
-        print(f"Erro ao conectar ao PostgreSQL no thread: {e}")
-        return None
-
-
-async def setup_database_connection_threaded():
-    """Inicia um thread para o loop do DB e conecta ao banco de dados."""
-    global _db_loop
-    if _db_loop is None or not _db_loop.is_running():
-        thread = threading.Thread(target=_run_db_loop, daemon=True)
-        thread.start()
-        await asyncio.sleep(0.1)  # Pequena pausa para o thread iniciar
-
-    conn = await asyncio.get_running_loop().run_in_executor(
-        None,
-        lambda: asyncio.run_coroutine_threadsafe(connect_to_db_in_thread(), _db_loop).result()
-    )
-    return conn
-
-
-async def close_database_connection_threaded():
-    """Fecha a conexão do banco de dados e para o loop do DB."""
-    global _db_conn, _db_loop
-    if _db_conn:
-        await asyncio.get_running_loop().run_in_executor(
-            None,
-            lambda: asyncio.run_coroutine_threadsafe(_db_conn.close(), _db_loop).result()
-        )
-        print("Conexão com o banco de dados fechada.")
-    if _db_loop and _db_loop.is_running():
-        _db_loop.call_soon_threadsafe(_db_loop.stop)
+# Crawl de vários alvos (pastas, buscas ou feeds) em paralelo, separados por vírgula
+CRAWL_TARGETS = [url.strip() for url in os.getenv("CRAWL_TARGETS", BOARD_URL).split(",") if url.strip()]
+PINS_PER_TARGET = int(os.getenv("PINS_PER_TARGET", MAX_IMAGES_TO_COLLECT))
+CRAWL_CONTEXTS = int(os.getenv("CRAWL_CONTEXTS", 2))
+CRAWL_PAGES_PER_CONTEXT = int(os.getenv("CRAWL_PAGES_PER_CONTEXT", 2))
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", 4))
+
+# Sessão autenticada salva em disco para evitar o login completo a cada execução
+SESSION_STATE_PATH = os.getenv("SESSION_STATE_PATH", ".pinterest_session.json")
+SESSION_CHECK_URL = "https://br.pinterest.com/"
+LOGIN_URL = "https://br.pinterest.com/login/"
+LOGIN_HOST = urlsplit(LOGIN_URL).hostname
+SESSION_CHECK_TIMEOUT = int(os.getenv("SESSION_CHECK_TIMEOUT", 10000))
+SESSION_COOKIE_NAME = "_pinterest_sess"
+LOGGED_IN_SELECTOR = (
+    'div[aria-label="Feed de início"], '
+    '[data-test-id="search-box"] input[type="search"], '
+    'div[data-test-id="pin"]'
+)
+
+# Bloqueio opcional de recursos que não servem para a coleta (fontes, mídia e rastreadores)
+BLOCK_RESOURCES = os.getenv("BLOCK_RESOURCES", "0") == "1"
+BLOCKED_RESOURCE_TYPES = {"font", "media"}
+BLOCKED_HOSTS_PATTERN = re.compile(
+    r'(google-analytics\.com|googletagmanager\.com|doubleclick\.net|googlesyndication\.com|'
+    r'facebook\.(com|net)|connect\.facebook\.net|hotjar\.com|segment\.(io|com)|'
+    r'sentry\.io|ct\.pinterest\.com|trk\.pinterest\.com)'
+)
+
+STEALTH_INIT_SCRIPT = """
+    Object.defineProperty(navigator, 'webdriver', {
+      get: () => undefined
+    });
+    Object.defineProperty(navigator, 'plugins', {
+        get: () => [
+            { name: 'Chrome PDF Viewer', description: 'Portable Document Format' },
+            { name: 'Chrome PDF Viewer', description: 'Portable Document Format' }
+        ]
+    });
+    Object.defineProperty(navigator, 'languages', {
+        get: () => ['pt-BR', 'pt', 'en-US', 'en']
+    });
+    Object.defineProperty(navigator, 'deviceMemory', {
+        get: () => 8
+    });
+    Object.defineProperty(navigator, 'hardwareConcurrency', {
+        get: () => 4
+    });
+    window.chrome = { runtime: {}, csi: () => {}, loadTimes: () => {} };
+    window.navigator.chrome = window.chrome;
+    window.console.debug = () => {};
+"""
+
+# Índice de pins já armazenados, usado para não coletar de novo o que já está no banco
+SKIP_SEEN_PINS = os.getenv("SKIP_SEEN_PINS", "1") == "1"
 
 
 async def login_pinterest(page: Page, email: str, password: str):
     """Tenta fazer login no Pinterest."""
     print("Tentando fazer login no Pinterest...")
     try:
-        await page.goto("https://br.pinterest.com/login/", wait_until="domcontentloaded")
+        await _paced_goto(page, LOGIN_URL)
         print(f"URL atual após goto login: {page.url}")
-        await asyncio.sleep(random.uniform(RANDOM_DELAY_MIN, RANDOM_DELAY_MAX))
+        await rate_limiter.acquire(LOGIN_HOST, "login")
 
         try:
             await page.locator('button[data-test-id="cookies-accept-btn"], button[aria-label="Aceitar cookies"]').click(
                 timeout=5000)
             print("Pop-up de cookies aceito.")
-            await asyncio.sleep(random.uniform(RANDOM_DELAY_MIN, RANDOM_DELAY_MAX))
+            await rate_limiter.acquire(LOGIN_HOST, "login")
         except PlaywrightTimeoutError:
             print("Nenhum pop-up de cookies encontrado ou já fechado.")
         except Exception as e:
             print(f"Erro ao tentar fechar pop-up de cookies: {e}")
 
         await page.fill('input[name="id"]', email)
-        await asyncio.sleep(random.uniform(0.5, 1.5))
+        await rate_limiter.acquire(LOGIN_HOST, "login")
         await page.fill('input[name="password"]', password)
-        await asyncio.sleep(random.uniform(1.0, 2.0))
+        await rate_limiter.acquire(LOGIN_HOST, "login")
         print(f"URL atual após preencher credenciais: {page.url}")
 
         print("Tentando clicar no botão de login...")
@@ -139,13 +156,7 @@ async def login_pinterest(page: Page, email: str, password: str):
         print(f"URL atual após tentativa de clique no login: {page.url}")
 
         try:
-            await page.wait_for_selector(
-                'div[aria-label="Feed de início"], '
-                '[data-test-id="search-box"] input[type="search"], '
-                'div[data-test-id="pin"]',
-                state='visible',
-                timeout=60000
-            )
+            await page.wait_for_selector(LOGGED_IN_SELECTOR, state='visible', timeout=60000)
             print(f"Elemento de feed logado encontrado. URL atual: {page.url}")
         except PlaywrightTimeoutError:
             print("Timeout esperando o elemento de feed logado. Pode não ter sido autenticado ou a página é diferente.")
@@ -173,325 +184,1060 @@ async def login_pinterest(page: Page, email: str, password: str):
         return False
 
 
-async def scrape_pin_data(pin_element):
-    """Extrai os dados de um único elemento pin."""
-    image_url = None
-    pin_url = None
-    title = None
-    description = None
-    pinterest_id = None
+PIN_SELECTOR = 'div[data-test-id="pin"]'
+PIN_TITLE_SELECTOR = (
+    'h1, [data-test-id="pin-closeup-title"], [data-test-id="pin-card-title"], div[data-test-id="pin-title"], '
+    '[data-test-id="card-title"]'
+)
+PIN_DESCRIPTION_SELECTOR = (
+    '[data-test-id="pin-closeup-description"], [data-test-id="pin-card-description"], '
+    'div[data-test-id="pin-description"], [data-test-id="card-description"]'
+)
+
+# Prefixos aceitos como imagem de pin (o benchmark troca pelo servidor local de imagens)
+PIN_IMAGE_URL_PREFIXES = ('https://i.pinimg.com/', 'data:image')
+# Conta, dentro da página, quantos pins já foram anexados ao DOM. O contador só cresce
+# e serve de sinal para rolar de novo sem depender de pausas fixas.
+INSTALL_PIN_OBSERVER_JS = """
+(pinSelector) => {
+    if (!window.__mayhemPinObserver) {
+        window.__mayhemPinCount = document.querySelectorAll(pinSelector).length;
+        window.__mayhemPinObserver = new MutationObserver(mutations => {
+            for (const mutation of mutations) {
+                for (const node of mutation.addedNodes) {
+                    if (node.nodeType !== Node.ELEMENT_NODE) continue;
+                    window.__mayhemPinCount += node.matches(pinSelector)
+                        ? 1 : node.querySelectorAll(pinSelector).length;
+                }
+            }
+        });
+        window.__mayhemPinObserver.observe(document.body, { childList: true, subtree: true });
+    }
+    return window.__mayhemPinCount;
+}
+"""
+
+# Respostas XHR do Pinterest que trazem pins (feed inicial, pastas, buscas, relacionados...)
+PIN_RESOURCE_URL_PATTERN = re.compile(r'/resource/\w+Resource/get/')
+# Os pins da primeira página vêm embutidos no HTML, nestes scripts JSON, e não por XHR
+INITIAL_STATE_SCRIPT_IDS = ["__PWS_INITIAL_PROPS__", "__PWS_DATA__"]
+READ_INITIAL_STATE_JS = "(ids) => ids.map(id => { const el = document.getElementById(id); return el ? el.textContent : null; })"
+# Pins já lidos ficam marcados com este atributo (ou são removidos do DOM no modo de
+# coleta longa), para que cada rolagem só processe os nós novos.
+PIN_DONE_ATTRIBUTE = "data-mayhem-done"
+PENDING_PIN_SELECTOR = f'{PIN_SELECTOR}:not([{PIN_DONE_ATTRIBUTE}])'
+
+# Extrai todos os pins ainda não lidos em uma única chamada, devolvendo
+# [src, srcset, pin_url, title, description] por pin. Pins sem imagem carregada
+# ficam para a próxima rolagem.
+EXTRACT_PINS_JS = """
+([pinSelector, titleSelector, descriptionSelector, doneAttribute, prune]) =>
+    Array.from(document.querySelectorAll(pinSelector), pin => {
+        const img = pin.querySelector('img');
+        const link = pin.querySelector('a[href*="/pin/"]');
+        const title = pin.querySelector(titleSelector);
+        const description = pin.querySelector(descriptionSelector);
+        const record = [
+            img ? img.getAttribute('src') : null,
+            img ? img.getAttribute('srcset') : null,
+            link ? link.getAttribute('href') : null,
+            title ? title.innerText : null,
+            description ? description.innerText : null
+        ];
+        if (record[0]) {
+            if (prune) pin.remove();
+            else pin.setAttribute(doneAttribute, '');
+        }
+        return record;
+    })
+"""
+
+MARK_PIN_DONE_JS = "(el, [doneAttribute, prune]) => prune ? el.remove() : el.setAttribute(doneAttribute, '')"
+
+
+def _clean_text(text):
+    if text:
+        return text.strip().replace('\n', ' ')
+    return text
+
+
+def _is_pin_image_url(image_url):
+    return image_url.startswith(PIN_IMAGE_URL_PREFIXES)
+
+
+def extract_pinterest_id(pin_url, image_url):
+    """Obtém o ID do pin pela URL do pin ou, na falta dela, pelo nome do arquivo da imagem."""
+    if pin_url:
+        match = re.search(r'/pin/(\d+)/', pin_url)
+        if match:
+            return match.group(1)
+    elif image_url:
+        match = re.search(r'/(\d+)x/(\d+)\.\w+$', image_url)
+        if match:
+            return match.group(2)
+        match = re.search(r'/(\d+)\.\w+$', image_url)
+        if match:
+            return match.group(1)
+    return None
+
+
+def build_pin_data(image_url, pin_url, title, description, board_url=BOARD_URL, srcset=None):
+    """Monta o dicionário de um pin a partir dos campos brutos, ou None se não for um pin válido."""
+    image_url = select_image_url(image_url, srcset)
+    # Validação da URL da imagem
+    if image_url and not _is_pin_image_url(image_url):
+        return None  # Retorna None se não for uma URL de imagem de pin válida
+
+    if pin_url and not pin_url.startswith('http'):
+        pin_url = f"https://br.pinterest.com{pin_url}"
+
+    pinterest_id = extract_pinterest_id(pin_url, image_url)
+    if image_url and pinterest_id:
+        return {
+            "pinterest_id": pinterest_id,
+            "title": _clean_text(title),
+            "description": _clean_text(description),
+            "image_url": image_url,
+            "board_url": board_url,
+            "pin_url": pin_url,
+            "collected_at": datetime.now()
+        }
+    return None
 
+
+def parse_pin_records(records, board_url=BOARD_URL):
+    """Converte as linhas devolvidas por EXTRACT_PINS_JS nos dicionários de pin."""
+    pins = []
+    for image_url, srcset, pin_url, title, description in records:
+        pin_data = build_pin_data(image_url, pin_url, title, description, board_url, srcset)
+        if pin_data:
+            pins.append(pin_data)
+    return pins
+
+
+async def extract_pins_batch(page: Page, board_url=BOARD_URL):
+    """Extrai os dados de todos os pins da página com um único page.evaluate."""
+    records = await page.evaluate(EXTRACT_PINS_JS, [PENDING_PIN_SELECTOR, PIN_TITLE_SELECTOR, PIN_DESCRIPTION_SELECTOR,
+                                                    PIN_DONE_ATTRIBUTE, LONG_CRAWL])
+    return parse_pin_records(records, board_url)
+
+
+async def scrape_pin_data(pin_element, board_url=BOARD_URL):
+    """Extrai os dados de um único elemento pin."""
     try:
         img_element = await pin_element.query_selector('img')
         image_url = await img_element.get_attribute('src') if img_element else None
+        srcset = await img_element.get_attribute('srcset') if img_element else None
 
-        # Validação da URL da imagem
-        if image_url and not (image_url.startswith('https://i.pinimg.com/') or image_url.startswith('data:image')):
-            # print(f"  Aviso: Image URL ({image_url}) não parece ser um pin real. Ignorando.")
-            return None  # Retorna None se não for uma URL de imagem de pin válida
-
+        pin_url = None
         pin_link_element = await pin_element.query_selector('a[href*="/pin/"]')
         if pin_link_element:
             pin_url = await pin_link_element.get_attribute('href')
-            if pin_url and not pin_url.startswith('http'):
-                pin_url = f"https://br.pinterest.com{pin_url}"
 
-        title_element = await pin_element.query_selector(
-            'h1, [data-test-id="pin-closeup-title"], [data-test-id="pin-card-title"], div[data-test-id="pin-title"], [data-test-id="card-title"]'
-        )
+        title = None
+        title_element = await pin_element.query_selector(PIN_TITLE_SELECTOR)
         if title_element:
             title = await title_element.inner_text()
-            if title:
-                title = title.strip().replace('\n', ' ')
 
-        description_element = await pin_element.query_selector(
-            '[data-test-id="pin-closeup-description"], [data-test-id="pin-card-description"], div[data-test-id="pin-description"], [data-test-id="card-description"]'
-        )
+        description = None
+        description_element = await pin_element.query_selector(PIN_DESCRIPTION_SELECTOR)
         if description_element:
             description = await description_element.inner_text()
-            if description:
-                description = description.strip().replace('\n', ' ')
-
-        if pin_url:
-            match = re.search(r'/pin/(\d+)/', pin_url)
-            if match:
-                pinterest_id = match.group(1)
-        elif image_url:
-            match = re.search(r'/(\d+)x/(\d+)\.\w+$', image_url)
-            if match:
-                pinterest_id = match.group(2)
-            else:
-                match = re.search(r'/(\d+)\.\w+$', image_url)
-                if match:
-                    pinterest_id = match.group(1)
-
-        if image_url and pinterest_id:
-            return {
-                "pinterest_id": pinterest_id,
-                "title": title,
-                "description": description,
-                "image_url": image_url,
-                "board_url": BOARD_URL,
-                "pin_url": pin_url,
-                "collected_at": datetime.now()
-            }
+
+        return build_pin_data(image_url, pin_url, title, description, board_url, srcset)
     except Exception as e:
         # print(f"Erro ao extrair dados de um pin: {e}") # Descomente para depurar erros de pin individual
         pass  # Ignora erros de pins individuais
     return None
 
 
-async def scroll_and_collect_pinterest(page: Page, target_images: int):
+async def _extract_pins_by_element(page: Page, board_url=BOARD_URL):
+    """Extrai os pins ainda não lidos um a um via ElementHandle (modo antigo, várias chamadas por pin)."""
+    pins_found = []
+    for pin_element in await page.query_selector_all(PENDING_PIN_SELECTOR):
+        img_element = await pin_element.query_selector('img')
+        if not (img_element and await img_element.get_attribute('src')):
+            continue  # Imagem ainda não carregada: fica para a próxima rolagem, como no modo batch
+        pin_data = await scrape_pin_data(pin_element, board_url)
+        if pin_data:
+            pins_found.append(pin_data)
+        await pin_element.evaluate(MARK_PIN_DONE_JS, [PIN_DONE_ATTRIBUTE, LONG_CRAWL])
+    return pins_found
+
+
+def _iter_resource_pins(payload):
+    """Percorre um payload JSON de recurso do Pinterest e produz os objetos de pin encontrados."""
+    if isinstance(payload, dict):
+        if payload.get("type") == "pin" and payload.get("id") and isinstance(payload.get("images"), dict):
+            yield payload
+            return
+        for value in payload.values():
+            yield from _iter_resource_pins(value)
+    elif isinstance(payload, list):
+        for item in payload:
+            yield from _iter_resource_pins(item)
+
+
+def pin_from_resource(pin_object: dict, board_url=BOARD_URL):
+    """Converte um objeto de pin da API interna no mesmo dicionário produzido por scrape_pin_data."""
+    variants = {
+        size: {"url": image.get("url"), "width": image.get("width"), "height": image.get("height")}
+        for size, image in pin_object["images"].items()
+        if isinstance(image, dict) and image.get("url")
+    }
+    image_url = next((variants[size]["url"] for size in resource_size_keys() if size in variants), None)
+    if not image_url and variants:
+        image_url = next(iter(variants.values()))["url"]
+    if not image_url:
+        return None
+
+    pinterest_id = str(pin_object["id"])
+    return {
+        "pinterest_id": pinterest_id,
+        "title": _clean_text(pin_object.get("title") or pin_object.get("grid_title")),
+        "description": _clean_text(pin_object.get("description")),
+        "image_url": image_url,
+        "board_url": board_url,
+        "pin_url": f"https://br.pinterest.com/pin/{pinterest_id}/",
+        "collected_at": datetime.now(),
+        "image_variants": variants
+    }
+
+
+def with_bookmark(resource_url: str, bookmark: str) -> str:
+    """Troca o bookmark (posição no feed) do parâmetro `data` de uma URL de recurso do Pinterest."""
+    parts = urlsplit(resource_url)
+    query = dict(parse_qsl(parts.query, keep_blank_values=True))
+    try:
+        data = json.loads(query.get("data") or "{}")
+    except ValueError:
+        return resource_url
+    data.setdefault("options", {})["bookmarks"] = [bookmark]
+    query["data"] = json.dumps(data, separators=(",", ":"))
+    return parts._replace(query=urlencode(query)).geturl()
+
+
+class FeedCursor:
     """
-    Rola a página e coleta os dados dos pins incrementalmente,
-    até atingir o número alvo de imagens ou o fim da rolagem.
+    Posição da coleta num alvo, mantida entre as páginas recicladas.
+
+    Ligado a cada página (`attach`) antes da navegação, acompanha as respostas de
+    recursos do feed: guarda os dois últimos bookmarks de paginação do Pinterest e,
+    no modo network, enfileira os pins delas e os embutidos no HTML
+    (`read_initial_state`). Só é ligado no modo network ou na coleta longa, que são
+    os que usam essas respostas; nos outros modos só conta as rolagens.
+    Também soma as rolagens que não trouxeram pins novos, para que o limite de
+    rolagens valha para o alvo inteiro e não recomece a cada página.
     """
-    collected_pins_data = {}  # Usaremos um dicionário para garantir unicidade pelo pinterest_id
-    last_height = await page.evaluate("document.body.scrollHeight")
-    scroll_count = 0
-    max_scrolls = 200  # Limite de rolagens para evitar loop infinito
 
-    # Adiciona um set para controlar os elementos de pin já processados nesta iteração de scroll
-    processed_pin_elements_ids = set()
+    def __init__(self, collect_pins: bool = True):
+        self.collect_pins = collect_pins
+        self.pending = asyncio.Queue()
+        self.bookmarks = deque(maxlen=2)  # Basta o penúltimo para retomar
+        self.empty_scrolls = 0
+
+    def attach(self, page: Page):
+        page.on("response", self.on_response)
 
-    print(f"Iniciando rolagem e coleta para {target_images} imagens...")
+    def detach(self, page: Page):
+        page.remove_listener("response", self.on_response)
 
-    while len(collected_pins_data) < target_images and scroll_count < max_scrolls:
-        # Espera para garantir que os pins estejam carregados e visíveis
-        await page.wait_for_selector('div[data-test-id="pin"]', state='attached', timeout=10000)
-        await asyncio.sleep(
-            random.uniform(RANDOM_DELAY_MIN / 2, RANDOM_DELAY_MAX / 2))  # Pequena pausa para elementos renderizarem
+    async def on_response(self, response):
+        if response.status != 200 or not PIN_RESOURCE_URL_PATTERN.search(response.url):
+            return
+        try:
+            payload = await response.json()
+        except Exception:
+            return  # Resposta sem corpo JSON (ou já descartada pelo navegador)
+        resource_response = payload.get("resource_response") if isinstance(payload, dict) else None
+        bookmark = resource_response.get("bookmark") if isinstance(resource_response, dict) else None
+        if bookmark and next(_iter_resource_pins(payload), None) is not None:
+            self.bookmarks.append(bookmark)
+        self._enqueue(payload)
+
+    async def read_initial_state(self, page: Page):
+        """Enfileira os pins do estado inicial embutido no HTML da página."""
+        if not self.collect_pins:
+            return
+        for text in await page.evaluate(READ_INITIAL_STATE_JS, INITIAL_STATE_SCRIPT_IDS):
+            if not text:
+                continue
+            try:
+                self._enqueue(json.loads(text))
+            except ValueError:
+                continue
+
+    def _enqueue(self, payload):
+        if not self.collect_pins:
+            return
+        for pin_object in _iter_resource_pins(payload):
+            self.pending.put_nowait(pin_object)
+
+    @property
+    def resume_bookmark(self):
+        """Bookmark que pede de novo a última página recebida (a anterior à última), ou None."""
+        return self.bookmarks[-2] if len(self.bookmarks) >= 2 else None
+
+    async def resume(self, page: Page) -> bool:
+        """
+        Faz a primeira requisição de recurso da página nova continuar do ponto salvo,
+        em vez do topo do feed. Os pins da última página são pedidos de novo (podem
+        não ter sido lidos) e o índice de pins vistos descarta os repetidos.
+        Retorna False se não há ponto salvo.
+        """
+        bookmark = self.resume_bookmark
+        if not bookmark:
+            return False
+        resumed = False
 
-        pins = await page.query_selector_all('div[data-test-id="pin"]')
+        async def continue_from_bookmark(route):
+            nonlocal resumed
+            if resumed:
+                await route.fallback()
+                return
+            resumed = True
+            await route.fallback(url=with_bookmark(route.request.url, bookmark))
 
-        current_batch_count = 0
-        for pin_element in pins:
-            # Playwright element handles have a unique ID that can be used for tracking
-            pin_element_id = await pin_element.evaluate(
-                "el => el.dataset.testId + '-' + el.getBoundingClientRect().top + '-' + el.getBoundingClientRect().left")
-
-            if pin_element_id not in processed_pin_elements_ids:
-                pin_data = await scrape_pin_data(pin_element)
-                if pin_data and pin_data["pinterest_id"] not in collected_pins_data:
-                    collected_pins_data[pin_data["pinterest_id"]] = pin_data
+        await page.route(PIN_RESOURCE_URL_PATTERN, continue_from_bookmark)
+        return True
+
+    def drain(self):
+        pin_objects = []
+        while not self.pending.empty():
+            pin_objects.append(self.pending.get_nowait())
+        return pin_objects
+
+
+async def iter_pinterest_pins_from_responses(page: Page, target_images: int, seen_index: SeenPinIndex = None,
+                                             board_url=BOARD_URL, cursor: FeedCursor = None):
+    """
+    Coleta os pins a partir das respostas JSON que o feed carrega durante a rolagem,
+    sem consultar o DOM.
+
+    Com `cursor` ligado à página antes da navegação (como faz crawl_target), os pins
+    do HTML inicial e das respostas da carga da página entram na coleta. Sem ele, o
+    cursor é criado aqui e só vê o HTML atual e as respostas das próximas rolagens.
+    """
+    own_cursor = cursor is None
+    if own_cursor:
+        cursor = FeedCursor()
+        cursor.attach(page)
+        await cursor.read_initial_state(page)
+    seen = seen_index if seen_index is not None else SeenPinIndex()
+    collected = 0
+    scroll_count = 0
+    idle_scrolls = 0
+    max_idle_scrolls = SCROLL_MAX_IDLE  # Rolagens seguidas sem nenhum pin novo antes de considerar o fim do feed
+    adaptive = SCROLL_MODE == "adaptive"
+    response_timeout = SCROLL_IDLE_TIMEOUT if adaptive else SCROLL_PAUSE_TIME + 1
+    last_scroll_at = 0.0
+    host = urlsplit(page.url).hostname
+
+    print(f"Iniciando rolagem e coleta para {target_images} imagens (modo network)...")
+    try:
+        while collected < target_images:
+            # Primeiro os pins que já chegaram (HTML inicial, carga da página); só rola quando acabarem
+            pin_objects = cursor.drain()
+            scrolled = not pin_objects
+            if scrolled:
+                if cursor.empty_scrolls >= SCROLL_MAX_EMPTY:
+                    print(f"Limite de rolagens sem pins novos ({SCROLL_MAX_EMPTY}) atingido. Encerrando rolagem.")
+                    break
+                if adaptive:
+                    await _wait_scroll_interval(last_scroll_at)
+                await rate_limiter.acquire(host, "scroll")
+                await page.evaluate("window.scrollTo(0, document.body.scrollHeight);")
+                last_scroll_at = time.monotonic()
+                scroll_count += 1
+                metrics.counter("scroll.count").inc()
+
+                # Espera a primeira resposta de pins desta rolagem em vez de dormir um tempo fixo
+                try:
+                    with metrics.timer("scroll.wait.seconds"):
+                        pin_objects = [await asyncio.wait_for(cursor.pending.get(), timeout=response_timeout)]
+                except asyncio.TimeoutError:
+                    pin_objects = []
+                pin_objects += cursor.drain()
+
+            with metrics.timer("extraction.seconds"):
+                pins_found = [pin_from_resource(pin_object, board_url) for pin_object in pin_objects]
+            metrics.counter("extraction.pins").inc(len(pins_found))
+
+            current_batch_count = 0
+            for pin_data in pins_found:
+                if pin_data and pin_data["pinterest_id"] not in seen:
+                    seen.add(pin_data["pinterest_id"])
+                    collected += 1
                     current_batch_count += 1
-                    print(
-                        f"  Coletado Pin {pin_data['pinterest_id']}. Total: {len(collected_pins_data)}/{target_images}")
-                processed_pin_elements_ids.add(pin_element_id)
+                    metrics.counter("pins.collected").inc()
+                    yield pin_data
+                    if collected >= target_images:
+                        break
+
+            if not scrolled:
+                continue
+            if not current_batch_count:
+                cursor.empty_scrolls += 1
+            print(f"Rolagem {scroll_count} concluída ({cursor.empty_scrolls}/{SCROLL_MAX_EMPTY} sem pins novos). "
+                  f"Pins únicos coletados até agora: {collected}/{target_images}")
+
+            idle_scrolls = 0 if current_batch_count else idle_scrolls + 1
+            if idle_scrolls >= max_idle_scrolls:
+                print("Nenhuma resposta com pins novos nas últimas rolagens. Fim do feed ou limite.")
+                break
+    finally:
+        if own_cursor:
+            cursor.detach(page)
+
+    print(f"Finalizado rolagem. Total de pins coletados: {collected}.")
+
+
+async def _wait_scroll_interval(last_scroll_at: float):
+    """Dorme o que falta para completar SCROLL_MIN_INTERVAL desde a última rolagem."""
+    remaining = SCROLL_MIN_INTERVAL - (time.monotonic() - last_scroll_at)
+    if remaining > 0:
+        await asyncio.sleep(remaining)
+
 
-        print(f"Pins únicos coletados até agora: {len(collected_pins_data)}/{target_images}")
+async def _wait_for_new_pins(page: Page, pin_count: int) -> int:
+    """
+    Espera o MutationObserver da página contar mais pins do que `pin_count`, por até
+    SCROLL_IDLE_TIMEOUT segundos. Retorna a contagem atual (igual à anterior se nada chegou).
+    """
+    try:
+        await page.wait_for_function("count => window.__mayhemPinCount > count", arg=pin_count,
+                                     timeout=SCROLL_IDLE_TIMEOUT * 1000)
+    except PlaywrightTimeoutError:
+        return pin_count
+    return await page.evaluate("window.__mayhemPinCount")
 
-        if len(collected_pins_data) >= target_images:
+
+async def iter_pinterest_pins(page: Page, target_images: int, seen_index: SeenPinIndex = None, board_url=BOARD_URL,
+                             cursor: FeedCursor = None):
+    """
+    Rola a página e produz os dados de cada pin novo assim que ele é encontrado,
+    até atingir o número alvo de imagens ou o fim da rolagem.
+
+    Como é um gerador assíncrono, a rolagem só avança quando quem consome os pins
+    pede o próximo, o que propaga a contrapressão das etapas seguintes. No modo
+    network, `cursor` traz as respostas capturadas desde antes da navegação.
+    """
+    if COLLECTOR_MODE == "network":
+        async for pin_data in iter_pinterest_pins_from_responses(page, target_images, seen_index, board_url, cursor):
+            yield pin_data
+        return
+
+    # Garante unicidade pelo pinterest_id (inclusive contra pins de execuções anteriores)
+    seen = seen_index if seen_index is not None else SeenPinIndex()
+    cursor = cursor if cursor is not None else FeedCursor(collect_pins=False)
+    collected = 0  # Só pins novos contam para o alvo
+    last_height = await page.evaluate("document.body.scrollHeight")
+    scroll_count = 0
+
+    adaptive = SCROLL_MODE == "adaptive"
+    idle_scrolls = 0
+    last_scroll_at = 0.0
+    host = urlsplit(page.url).hostname
+    if adaptive:
+        await page.wait_for_selector(PIN_SELECTOR, state='attached', timeout=10000)
+        pin_count = await page.evaluate(INSTALL_PIN_OBSERVER_JS, PIN_SELECTOR)
+
+    print(f"Iniciando rolagem e coleta para {target_images} imagens "
+          f"(modo {COLLECTOR_MODE}, rolagem {SCROLL_MODE})...")
+
+    while collected < target_images:
+        if not adaptive:
+            # Espera para garantir que os pins estejam carregados e visíveis
+            with metrics.timer("scroll.wait.seconds"):
+                await page.wait_for_selector(PIN_SELECTOR, state='attached', timeout=10000)
+
+        with metrics.timer("extraction.seconds"):
+            if COLLECTOR_MODE == "element":
+                pins_found = await _extract_pins_by_element(page, board_url)
+            else:
+                pins_found = await extract_pins_batch(page, board_url)
+        metrics.counter("extraction.pins").inc(len(pins_found))
+
+        current_batch_count = 0
+        for pin_data in pins_found:
+            if pin_data["pinterest_id"] not in seen:
+                seen.add(pin_data["pinterest_id"])
+                collected += 1
+                current_batch_count += 1
+                metrics.counter("pins.collected").inc()
+                yield pin_data
+
+        if scroll_count and not current_batch_count:
+            cursor.empty_scrolls += 1
+        print(f"Pins únicos coletados até agora: {collected}/{target_images}")
+
+        if collected >= target_images:
             print("Número alvo de pins atingido durante a rolagem. Encerrando rolagem.")
             break
 
-        # Rolar a página
-        await page.evaluate("window.scrollTo(0, document.body.scrollHeight);")
-        await asyncio.sleep(random.uniform(SCROLL_PAUSE_TIME, SCROLL_PAUSE_TIME + 1))  # Pausa para o conteúdo carregar
+        if adaptive:
+            # Rola de novo assim que o observer acusar pins novos, respeitando o intervalo mínimo
+            with metrics.timer("scroll.wait.seconds"):
+                await _wait_scroll_interval(last_scroll_at)
+                await rate_limiter.acquire(host, "scroll")
+                await page.evaluate("window.scrollTo(0, document.body.scrollHeight);")
+                last_scroll_at = time.monotonic()
+                new_pin_count = await _wait_for_new_pins(page, pin_count)
+            scroll_count += 1
+            metrics.counter("scroll.count").inc()
+            print(f"Rolagem {scroll_count} concluída ({cursor.empty_scrolls}/{SCROLL_MAX_EMPTY} sem pins novos).")
+
+            idle_scrolls = 0 if new_pin_count > pin_count else idle_scrolls + 1
+            pin_count = new_pin_count
+            if idle_scrolls >= SCROLL_MAX_IDLE:
+                print("Nenhum pin novo apareceu nas últimas rolagens. Fim da página ou limite.")
+                break
+        else:
+            # Rolar a página
+            with metrics.timer("scroll.wait.seconds"):
+                await rate_limiter.acquire(host, "scroll")
+                await page.evaluate("window.scrollTo(0, document.body.scrollHeight);")
+                await asyncio.sleep(SCROLL_PAUSE_TIME)  # Pausa para o conteúdo carregar
 
-        new_height = await page.evaluate("document.body.scrollHeight")
-        scroll_count += 1
-        print(f"Rolagem {scroll_count} de {max_scrolls} concluída.")
+            new_height = await page.evaluate("document.body.scrollHeight")
+            scroll_count += 1
+            metrics.counter("scroll.count").inc()
+            print(f"Rolagem {scroll_count} concluída ({cursor.empty_scrolls}/{SCROLL_MAX_EMPTY} sem pins novos).")
 
-        if new_height == last_height and current_batch_count == 0:  # Nenhuma nova altura e nenhum novo pin coletado na última iteração
-            print("Não há mais conteúdo para rolar ou nenhum novo pin foi encontrado. Fim da página ou limite.")
-            break
+            if new_height == last_height and current_batch_count == 0:  # Nenhuma nova altura e nenhum novo pin coletado na última iteração
+                print("Não há mais conteúdo para rolar ou nenhum novo pin foi encontrado. Fim da página ou limite.")
+                break
 
-        last_height = new_height
+            last_height = new_height
 
-        if scroll_count >= max_scrolls:
-            print(f"Limite máximo de rolagens ({max_scrolls}) atingido. Encerrando rolagem.")
+        if cursor.empty_scrolls >= SCROLL_MAX_EMPTY:
+            print(f"Limite de rolagens sem pins novos ({SCROLL_MAX_EMPTY}) atingido. Encerrando rolagem.")
             break
 
-    print(f"Finalizado rolagem. Total de pins coletados: {len(collected_pins_data)}.")
-    return list(collected_pins_data.values())  # Retorna a lista de dicionários de dados dos pins
+    print(f"Finalizado rolagem. Total de pins coletados: {collected}.")
 
 
-async def save_image_locally(image_url: str, save_dir: str):
-    """Baixa uma imagem para o diretório local."""
-    if not image_url:
-        return None
+async def scroll_and_collect_pinterest(page: Page, target_images: int, seen_index: SeenPinIndex = None,
+                                       board_url=BOARD_URL):
+    """Rola a página e devolve a lista completa de dicionários de dados dos pins."""
+    return [pin_data async for pin_data in iter_pinterest_pins(page, target_images, seen_index, board_url)]
 
-    os.makedirs(save_dir, exist_ok=True)
-    pinterest_id_match = re.search(r'/(\w+)\.\w+$', image_url)
-    if pinterest_id_match:
-        filename = f"{pinterest_id_match.group(1)}.jpg"
-    else:
-        filename = image_url.split('/')[-1]
-        filename = filename.split('?')[0]
-        filename = re.sub(r'[^\w\-. ]', '', filename)[:100] + ".jpg"
 
-    file_path = os.path.join(save_dir, filename)
+class CrawlPipeline:
+    """
+    Liga coleta, download e gravação no banco por meio de filas limitadas.
+
+    Os pins entram por `feed` e passam pela fila de download e depois pela fila do
+    banco. Quando uma etapa fica para trás, sua fila enche e o `put` da etapa
+    anterior bloqueia, até chegar ao gerador de coleta, que para de rolar a página.
+    """
 
-    if os.path.exists(file_path):
-        return file_path
+    def __init__(self, downloader, ingestor: ImageIngestor, queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.downloader = downloader
+        self.ingestor = ingestor
+        self.download_queue = asyncio.Queue(maxsize=queue_size)
+        self.db_queue = asyncio.Queue(maxsize=queue_size)
+        self.collected = 0
+        self._workers = []
+
+    def start(self):
+        """Inicia os workers de download (um por slot de concorrência) e o de banco."""
+        for _ in range(self.downloader.concurrency):
+            self._workers.append(asyncio.create_task(self._download_worker()))
+        self._workers.append(asyncio.create_task(self._db_worker()))
+
+    async def feed(self, pins):
+        """Consome um iterável assíncrono de pins, enfileirando-os para download. Retorna quantos foram."""
+        fed = 0
+        async for pin_data in pins:
+            await self.download_queue.put(pin_data)
+            self.collected += 1
+            fed += 1
+        return fed
+
+    async def _download_worker(self):
+        from storage import download_pin  # Import tardio: a etapa crawl sozinha não carrega o aiohttp
+
+        while True:
+            pin_data = await self.download_queue.get()
+            try:
+                await self.db_queue.put(await download_pin(self.downloader, pin_data))
+            except Exception as e:
+                print(f"Erro inesperado no download do pin {pin_data.get('pinterest_id')}: {e}")
+            finally:
+                self.download_queue.task_done()
+
+    async def _db_worker(self):
+        while True:
+            pin_data = await self.db_queue.get()
+            try:
+                await self.ingestor.add(pin_data)
+            except Exception as e:
+                print(f"Erro inesperado ao enfileirar o pin {pin_data.get('pinterest_id')} para o DB: {e}")
+            finally:
+                self.db_queue.task_done()
+
+    async def drain(self):
+        """Espera todos os pins enfileirados passarem pelo download e pelo banco."""
+        await self.download_queue.join()
+        await self.db_queue.join()
+        await self.ingestor.flush()
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+async def _block_unneeded_requests(route):
+    """Aborta fontes, mídia e rastreadores de terceiros; o resto segue normalmente."""
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or BLOCKED_HOSTS_PATTERN.search(urlsplit(request.url).netloc):
+        await route.abort()
+    else:
+        await route.continue_()
 
+
+def load_session_state(path: str = SESSION_STATE_PATH):
+    """
+    Lê o storage_state salvo e faz uma verificação barata, sem abrir o navegador:
+    o cookie de sessão do Pinterest precisa existir e não estar expirado.
+    Retorna o estado ou None.
+    """
+    if not os.path.exists(path):
+        return None
     try:
-        process = await asyncio.create_subprocess_shell(
-            f'curl -o "{file_path}" "{image_url}"',
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-
-        if process.returncode == 0:
-            return file_path
-        else:
-            print(f"Erro ao baixar {image_url}: {stderr.decode()}")
-            return None
-    except Exception as e:
-        print(f"Exceção ao baixar {image_url}: {e}")
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Não foi possível ler a sessão salva em {path}: {e}")
+        return None
+
+    session_cookie = next((cookie for cookie in state.get("cookies", []) if cookie.get("name") == SESSION_COOKIE_NAME),
+                          None)
+    if not session_cookie:
+        print("Sessão salva não tem o cookie de sessão do Pinterest.")
+        return None
+    expires = session_cookie.get("expires", -1)
+    if expires != -1 and expires < time.time():
+        print("Sessão salva expirou.")
         return None
+    return state
 
 
-async def insert_image_data(image_data: dict):
-    """Insere os dados de uma imagem no banco de dados, usando o loop do DB em um thread separado."""
-    global _db_conn, _db_loop
-    if not _db_conn or not _db_loop or not _db_loop.is_running():
-        print("Conexão com o banco de dados não está ativa para inserção.")
+async def save_session_state(context, path: str = SESSION_STATE_PATH):
+    """Salva o storage_state do contexto autenticado (cookies e localStorage) em disco."""
+    state = await context.storage_state(path=path)
+    os.chmod(path, 0o600)  # Contém cookies de sessão
+    print(f"Sessão do Pinterest salva em {path}.")
+    return state
+
+
+async def session_is_valid(browser, storage_state) -> bool:
+    """Abre a página inicial com a sessão salva e confere se o Pinterest ainda a reconhece."""
+    context = await new_browser_context(browser, storage_state)
+    try:
+        page = await context.new_page()
+        await page.goto(SESSION_CHECK_URL, wait_until="domcontentloaded")
+        if "/login" in page.url:
+            return False
+        await page.wait_for_selector(LOGGED_IN_SELECTOR, state='attached', timeout=SESSION_CHECK_TIMEOUT)
+        return "/login" not in page.url
+    except PlaywrightTimeoutError:
         return False
+    except PlaywrightError as e:
+        # net::ERR_* e afins: sem como confirmar a sessão, o login completo decide
+        print(f"Erro ao conferir a sessão salva: {e}")
+        return False
+    finally:
+        await context.close()
+
+
+async def ensure_session(browser, email: str, password: str):
+    """
+    Devolve um storage_state autenticado, reaproveitando a sessão salva quando ela
+    ainda vale e fazendo o login completo só quando necessário.
+    Retorna None se o login falhar.
+    """
+    storage_state = load_session_state()
+    if storage_state:
+        with metrics.timer("login.session_check.seconds"):
+            session_valid = await session_is_valid(browser, storage_state)
+        if session_valid:
+            print("Sessão salva reaproveitada; login não é necessário.")
+            return storage_state
+        print("Sessão salva não é mais aceita pelo Pinterest. Fazendo login completo...")
+
+    login_context = await new_browser_context(browser)
     try:
-        await asyncio.get_running_loop().run_in_executor(
-            None,
-            lambda: asyncio.run_coroutine_threadsafe(
-                _db_conn.execute(
-                    """
-                    INSERT INTO images (pinterest_id, title, description, image_url, board_url, pin_url, collected_at)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7)
-                    ON CONFLICT (pinterest_id) DO NOTHING;
-                    """,
-                    image_data["pinterest_id"],
-                    image_data["title"],
-                    image_data["description"],
-                    image_data["image_url"],
-                    image_data["board_url"],
-                    image_data["pin_url"],
-                    image_data["collected_at"],
-                ), _db_loop
-            ).result()
-        )
+        page = await login_context.new_page()
+        with metrics.timer("login.seconds"):
+            logged_in = await login_pinterest(page, email, password)
+        if not logged_in:
+            return None
+        return await save_session_state(login_context)
+    finally:
+        await login_context.close()
+
+
+def _record_feed_response(response):
+    """Usa as respostas dos recursos de pins (carregados pela rolagem) para ajustar o ritmo de rolagem do host."""
+    if PIN_RESOURCE_URL_PATTERN.search(response.url):
+        rate_limiter.record(urlsplit(response.url).hostname, "scroll", response.status,
+                            retry_after=response.headers.get("retry-after"))
+
+
+async def new_browser_context(browser, storage_state=None):
+    """Cria um contexto do navegador com as configurações anti-detecção e, se houver, a sessão salva."""
+    context = await browser.new_context(
+        user_agent=USER_AGENT,
+        viewport={'width': VIEWPORT_WIDTH, 'height': VIEWPORT_HEIGHT},
+        locale='pt-BR',
+        timezone_id='America/Sao_Paulo',
+        storage_state=storage_state
+    )
+    await context.add_init_script(STEALTH_INIT_SCRIPT)
+    context.on("response", _record_feed_response)
+    if BLOCK_RESOURCES:
+        await context.route("**/*", _block_unneeded_requests)
+    return context
+
+
+async def _page_needs_recycle(page: Page, pins_on_page: int) -> bool:
+    """Diz se a página passou do limite de pins ou de heap JS do modo de coleta longa."""
+    if RECYCLE_AFTER_PINS and pins_on_page >= RECYCLE_AFTER_PINS:
         return True
-    except asyncpg.exceptions.PostgresError as e:
-        print(f"Erro ao inserir dados no banco de dados para {image_data.get('pin_url')}: {e}")
-        return False
+    if RECYCLE_HEAP_MB and pins_on_page % RECYCLE_CHECK_EVERY == 0:
+        heap_bytes = await page.evaluate("performance.memory ? performance.memory.usedJSHeapSize : 0")
+        metrics.gauge("page.js_heap.bytes").set(heap_bytes)
+        return heap_bytes >= RECYCLE_HEAP_MB * 1024 * 1024
+    return False
+
+
+async def _paced_goto(page: Page, url: str):
+    """Navega respeitando o limite de navegações do host e informa o resultado ao rate_limiter."""
+    host = urlsplit(url).hostname
+    await rate_limiter.acquire(host, "navigate")
+    try:
+        response = await page.goto(url, wait_until="domcontentloaded")
+    except PlaywrightTimeoutError:
+        rate_limiter.record(host, "navigate", timeout=True)
+        raise
+    rate_limiter.record(host, "navigate", response.status if response else None,
+                        retry_after=response.headers.get("retry-after") if response else None)
+    return response
+
+
+async def crawl_target(context, target_url: str, pipeline: CrawlPipeline, seen_index: SeenPinIndex, budget: int):
+    """
+    Abre um alvo (pasta, busca ou feed) numa página nova do contexto e envia até
+    `budget` pins novos para o pipeline.
+
+    No modo de coleta longa a página é trocada por uma nova quando passa de
+    RECYCLE_AFTER_PINS pins ou RECYCLE_HEAP_MB de heap JS. A coleta continua no mesmo
+    alvo com o orçamento restante: a página nova retoma o feed a partir do último
+    bookmark recebido (o FeedCursor é o mesmo para todas as páginas do alvo), e o
+    índice de pins vistos descarta os repetidos do HTML inicial.
+    """
+    stats = {"target": target_url, "collected": 0, "status": "ok", "elapsed": 0.0, "error": None, "recycles": 0}
+    started = time.perf_counter()
+    page = await context.new_page()
+    try:
+        print(f"Iniciando rolagem e coleta em {target_url}...")
+        cursor = FeedCursor(collect_pins=COLLECTOR_MODE == "network")
+        # Ler os corpos das respostas do feed custa IPC a cada rolagem; só vale no modo
+        # network (são os pins) e na coleta longa (o bookmark para retomar após reciclar)
+        follow_feed = COLLECTOR_MODE == "network" or LONG_CRAWL
+        while stats["collected"] < budget:
+            if stats["recycles"] and await cursor.resume(page):
+                print(f"Retomando {target_url} do último bookmark do feed.")
+            # Ligado antes da navegação para não perder as respostas da carga da página
+            if follow_feed:
+                cursor.attach(page)
+            await _paced_goto(page, target_url)
+            await cursor.read_initial_state(page)
+
+            pins = iter_pinterest_pins(page, budget - stats["collected"], seen_index, target_url, cursor)
+            recycle = False
+
+            async def counted_pins():
+                nonlocal recycle
+                pins_on_page = 0
+                async for pin_data in pins:
+                    stats["collected"] += 1
+                    pins_on_page += 1
+                    yield pin_data
+                    if LONG_CRAWL and await _page_needs_recycle(page, pins_on_page):
+                        recycle = True
+                        return
+
+            try:
+                await pipeline.feed(counted_pins())
+            finally:
+                await pins.aclose()
+                if follow_feed:
+                    cursor.detach(page)
+            if not recycle:
+                break
+
+            stats["recycles"] += 1
+            metrics.counter("pages.recycled").inc()
+            print(f"Reciclando a página de {target_url} após {stats['collected']} pins.")
+            old_page, page = page, await context.new_page()
+            await old_page.close()
+    except PlaywrightTimeoutError as e:
+        stats.update(status="timeout", error=str(e))
+        print(f"Erro de timeout durante o scraping de {target_url}: {e}")
+        print(f"URL no momento do timeout: {page.url}")
     except Exception as e:
-        print(f"Erro inesperado ao inserir dados: {e}")
-        return False
+        stats.update(status="error", error=str(e))
+        print(f"Erro geral durante o scraping de {target_url}: {e}")
+        print(f"URL no momento do erro geral: {page.url}")
+    finally:
+        await page.close()
+    stats["elapsed"] = time.perf_counter() - started
+    metrics.counter(f"targets.{stats['status']}").inc()
+    metrics.histogram("targets.seconds").observe(stats["elapsed"])
+    return stats
+
+
+async def crawl_targets(browser, targets, pipeline: CrawlPipeline, seen_index: SeenPinIndex, storage_state=None,
+                        contexts: int = CRAWL_CONTEXTS, pages_per_context: int = CRAWL_PAGES_PER_CONTEXT,
+                        concurrency: int = CRAWL_CONCURRENCY, budget: int = PINS_PER_TARGET):
+    """
+    Distribui os alvos por um pool de contextos e páginas que compartilham o mesmo
+    navegador e a mesma sessão.
+
+    Cada contexto atende até `pages_per_context` alvos ao mesmo tempo, cada um em sua
+    própria página; quem termina pega o próximo alvo da fila, e no máximo
+    `concurrency` alvos rolam ao mesmo tempo. Retorna as estatísticas de cada alvo.
+    """
+    pending = asyncio.Queue()
+    for target_url in targets:
+        pending.put_nowait(target_url)
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def worker(context):
+        while True:
+            try:
+                target_url = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            async with semaphore:
+                results.append(await crawl_target(context, target_url, pipeline, seen_index, budget))
+
+    # Não abre mais páginas do que alvos
+    contexts = max(1, min(contexts, -(-len(targets) // pages_per_context)))
+    browser_contexts = [await new_browser_context(browser, storage_state) for _ in range(contexts)]
+    try:
+        slots = [context for context in browser_contexts for _ in range(pages_per_context)]
+        await asyncio.gather(*(worker(context) for context in slots[:len(targets)]))
+    finally:
+        for context in browser_contexts:
+            await context.close()
+    return results
+
+
+async def launch_browser(playwright):
+    """Abre o Chromium headless com as opções anti-detecção."""
+    return await playwright.chromium.launch(
+        headless=True,
+        args=[
+            '--no-sandbox',
+            '--disable-setuid-sandbox',
+            '--disable-blink-features=AutomationControlled',
+            '--disable-gpu',
+            '--no-zygote'
+        ]
+    )
+
+
+async def authenticate(browser):
+    """
+    Garante a sessão do Pinterest quando há credenciais configuradas.
+    Retorna (ok, storage_state); sem credenciais, (True, None).
+    """
+    if not (PINTEREST_EMAIL and PINTEREST_PASSWORD):
+        print("Nenhuma credencial de login do Pinterest fornecida. Prosseguindo sem login.")
+        return True, None
+    print("Credenciais de login fornecidas. Verificando a sessão do Pinterest...")
+    # A sessão autenticada é compartilhada por todos os contextos do pool
+    storage_state = await ensure_session(browser, PINTEREST_EMAIL, PINTEREST_PASSWORD)
+    if not storage_state:
+        print("Login falhou ou não pôde ser verificado. Encerrando o scraping.")
+        return False, None
+    return True, storage_state
+
+
+def _print_crawl_summary(results, pipeline, ingestor: ImageIngestor = None):
+    print(f"--- Coleta Concluída! ---")
+    for result in results:
+        print(f"  {result['target']}: {result['collected']} pins novos em {result['elapsed']:.1f}s "
+              f"({result['status']})")
+    print(f"Total de pins novos coletados: {pipeline.collected}")
+    if ingestor is not None:
+        print(f"Imagens únicas inseridas no DB: {ingestor.inserted_total}")
+        print(f"Pins já existentes no DB (duplicados): {ingestor.duplicate_total}")
+        if ingestor.spooled_total:
+            print(f"Pins recusados pelo DB e guardados no spool para `python cli.py ingest`: {ingestor.spooled_total}")
+
+
+async def _load_seen_for_spool(seen_index: SeenPinIndex, stage: str):
+    """
+    Preenche o índice de pins conhecidos para a coleta em spool: os pins do banco,
+    se ele estiver acessível, e os que já estão no spool (de coletas interrompidas
+    ou ainda não ingeridas).
+    """
+    pool = await create_db_pool()
+    if pool:
+        try:
+            await seen_index.load(pool)
+        except asyncpg.exceptions.PostgresError as e:
+            print(f"Não foi possível ler os pins conhecidos do banco: {e}")
+        finally:
+            await pool.close()
+    else:
+        print("Seguindo sem o banco; só os pins do spool serão pulados.")
+    from_spool = 0
+    for record in spool.SpoolReader(stage, "crawl").read_all():
+        seen_index.add(record.get("pinterest_id"))
+        from_spool += 1
+    print(f"Pins já presentes no spool '{stage}': {from_spool}.")
+
+
+async def crawl_to_spool(stage: str = "crawl"):
+    """
+    Etapa `crawl` da linha de comando: coleta os pins dos alvos e só os grava no
+    spool local, sem baixar imagens nem depender do banco. As etapas `fetch` e
+    `ingest` continuam a partir do spool quando for conveniente.
+    """
+    seen_index = SeenPinIndex()
+    if SKIP_SEEN_PINS:
+        await _load_seen_for_spool(seen_index, stage)
+    metrics_runner = await metrics.serve_metrics(METRICS_PORT) if METRICS_PORT else None
+
+    try:
+        with spool.SpoolWriter(stage) as writer:
+            pipeline = spool.SpoolPipeline(writer)
+            async with async_playwright() as p:
+                browser = await launch_browser(p)
+                try:
+                    authenticated, storage_state = await authenticate(browser)
+                    if not authenticated:
+                        return
+                    results = await crawl_targets(browser, CRAWL_TARGETS, pipeline, seen_index, storage_state)
+                finally:
+                    await browser.close()
+        _print_crawl_summary(results, pipeline)
+        print(f"Pins gravados no spool: {writer.written} (em {writer.path})")
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 
 async def main():
     """Função principal para orquestrar o scraping."""
-    import nest_asyncio
-    nest_asyncio.apply()
-
-    conn = await setup_database_connection_threaded()
-    if not conn:
+    pool = await create_db_pool()
+    if not pool:
         print("Não foi possível estabelecer conexão com o banco de dados. Encerrando.")
-        await close_database_connection_threaded()
         return
 
+    try:
+        await schema.migrate(pool)
+    except asyncpg.exceptions.PostgresError as e:
+        print(f"Erro ao aplicar as migrações do banco de dados: {e}")
+        await pool.close()
+        return
+
+    # O índice de pins conhecidos carrega em paralelo com a abertura do navegador e o login
+    seen_index = SeenPinIndex()
+    seen_index_task = asyncio.create_task(seen_index.load(pool)) if SKIP_SEEN_PINS else None
+    metrics_runner = await metrics.serve_metrics(METRICS_PORT) if METRICS_PORT else None
+
     async with async_playwright() as p:
-        browser = await p.chromium.launch(
-            headless=True,
-            args=[
-                '--no-sandbox',
-                '--disable-setuid-sandbox',
-                '--disable-blink-features=AutomationControlled',
-                '--disable-gpu',
-                '--no-zygote',
-                '--single-process'
-            ]
-        )
-        context = await browser.new_context(
-            user_agent=USER_AGENT,
-            viewport={'width': VIEWPORT_WIDTH, 'height': VIEWPORT_HEIGHT},
-            locale='pt-BR',
-            timezone_id='America/Sao_Paulo'
-        )
-
-        await context.add_init_script("""
-            Object.defineProperty(navigator, 'webdriver', {
-              get: () => undefined
-            });
-            Object.defineProperty(navigator, 'plugins', {
-                get: () => [
-                    { name: 'Chrome PDF Viewer', description: 'Portable Document Format' },
-                    { name: 'Chrome PDF Viewer', description: 'Portable Document Format' }
-                ]
-            });
-            Object.defineProperty(navigator, 'languages', {
-                get: () => ['pt-BR', 'pt', 'en-US', 'en']
-            });
-            Object.defineProperty(navigator, 'deviceMemory', {
-                get: () => 8
-            });
-            Object.defineProperty(navigator, 'hardwareConcurrency', {
-                get: () => 4
-            });
-            window.chrome = { runtime: {}, csi: () => {}, loadTimes: () => {} };
-            window.navigator.chrome = window.chrome;
-            window.console.debug = () => {};
-        """)
+        browser = await launch_browser(p)
+        authenticated, storage_state = await authenticate(browser)
+        if not authenticated:
+            if seen_index_task:
+                seen_index_task.cancel()
+            await pool.close()
+            await browser.close()
+            if metrics_runner:
+                await metrics_runner.cleanup()
+            return
+
+        # Lotes que o banco recusar vão para o spool do fetch, de onde `cli.py ingest` os grava
+        fallback_spool = spool.SpoolWriter("fetch")
+        ingestor = ImageIngestor(pool, fallback_spool=fallback_spool)
+        ingestor.start()
+        try:
+            refresher = None
+            if seen_index_task:
+                await seen_index_task
+                refresher = asyncio.create_task(seen_index.refresh_periodically(pool))
 
-        page = await context.new_page()
+            if JOB_QUEUE:
+                # Import tardio: só o modo distribuído usa o job_queue
+                from job_queue import JobQueue, QueueingPipeline
 
-        if PINTEREST_EMAIL and PINTEREST_PASSWORD:
-            print("Credenciais de login fornecidas. Tentando login no Pinterest...")
-            logged_in = await login_pinterest(page, PINTEREST_EMAIL, PINTEREST_PASSWORD)
-            if not logged_in:
-                print("Login falhou ou não pôde ser verificado. Encerrando o scraping.")
-                await close_database_connection_threaded()
-                await browser.close()
+                queue = JobQueue(pool)
+                pipeline = QueueingPipeline(ingestor, queue)
+                try:
+                    results = await crawl_targets(browser, CRAWL_TARGETS, pipeline, seen_index, storage_state)
+                    await pipeline.drain()
+                finally:
+                    await pipeline.close()
+                    if refresher:
+                        refresher.cancel()
+                _print_crawl_summary(results, pipeline, ingestor)
+                print(f"Jobs de download enfileirados: {pipeline.enqueued}")
                 return
 
-        else:
-            print("Nenhuma credencial de login do Pinterest fornecida. Prosseguindo sem login.")
+            from storage import ImageDownloader
+
+            # Downloads e inserções acontecem enquanto as páginas ainda estão rolando.
+            async with ImageDownloader() as downloader:
+                pipeline = CrawlPipeline(downloader, ingestor)
+                pipeline.start()
+                try:
+                    results = await crawl_targets(browser, CRAWL_TARGETS, pipeline, seen_index, storage_state)
+                    print("Rolagem encerrada. Aguardando downloads e inserções pendentes...")
+                    await pipeline.drain()
+                finally:
+                    await pipeline.close()
+                    if refresher:
+                        refresher.cancel()
+
+            stats = downloader.stats
+            mean_latency = stats["seconds"] / stats["downloaded"] if stats["downloaded"] else 0.0
+
+            _print_crawl_summary(results, pipeline, ingestor)
+            print(f"Imagens baixadas localmente: {stats['downloaded']} novas, "
+                  f"{stats['existing']} com conteúdo já armazenado, "
+                  f"{stats['failed']} falhas ({stats['retries']} novas tentativas)")
+            print(f"Bytes baixados: {stats['bytes']}, gravados em disco: {stats['bytes_stored']} "
+                  f"({stats['transcoded']} transcodificadas, {stats['fallbacks']} resoluções alternativas; "
+                  f"latência média por download: {mean_latency:.3f}s)")
 
-        try:
-            print(f"Iniciando rolagem e coleta na página atual ({page.url})...")
-            await asyncio.sleep(random.uniform(RANDOM_DELAY_MIN, RANDOM_DELAY_MAX))
-
-            # Agora, esta função vai rolar E coletar os dados
-            images_data = await scroll_and_collect_pinterest(page, MAX_IMAGES_TO_COLLECT)
-
-            print(f"Iniciando download e inserção de dados para {len(images_data)} imagens.")
-            inserted_count = 0
-            downloaded_count = 0
-
-            # Como collected_pins_data já lida com unicidade por pinterest_id,
-            # não precisamos mais do `processed_pin_ids` aqui.
-
-            for img_data in images_data:
-                if img_data.get("image_url"):
-                    local_path = await save_image_locally(img_data["image_url"], IMAGE_SAVE_DIR)
-                    if local_path:
-                        downloaded_count += 1
-
-                success = await insert_image_data(img_data)
-                if success:
-                    inserted_count += 1
-                await asyncio.sleep(random.uniform(0.1, 0.5))
-
-            print(f"--- Coleta Concluída! ---")
-            print(f"Total de pins únicos coletados na página: {len(images_data)}")
-            print(f"Imagens únicas inseridas no DB: {inserted_count}")
-            print(f"Imagens baixadas localmente: {downloaded_count}")
-
-        except PlaywrightTimeoutError as e:
-            print(f"Erro de timeout durante o scraping: {e}")
-            print(f"URL no momento do timeout: {page.url}")
-            print("Verifique sua conexão ou se o Pinterest está bloqueando.")
         except Exception as e:
             print(f"Erro geral durante o scraping: {e}")
-            print(f"URL no momento do erro geral: {page.url}")
         finally:
-            await close_database_connection_threaded()
+            await ingestor.close()
+            fallback_spool.close()
+            await pool.close()
             await browser.close()
+            metrics.REGISTRY.write_json(METRICS_OUTPUT)
+            if metrics_runner:
+                await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":
     if sys.platform == "win32":
         asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
-    os.makedirs(IMAGE_SAVE_DIR, exist_ok=True)
-    asyncio.run(main())
\ No newline at end of file
+    if PROFILE_OUTPUT:
+        metrics.profile_run(lambda: asyncio.run(main()), PROFILE_OUTPUT)
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,178 @@
+"""
+Limitador de taxa adaptativo compartilhado por todas as páginas e downloads do processo.
+
+Cada par (host, ação) tem um token bucket próprio ("navigate", "scroll", "login",
+"download"). Quem vai fazer uma requisição chama `acquire` e espera um token; depois
+informa o resultado com `record`. Respostas saudáveis aumentam a taxa aos poucos
+(aumento aditivo); 429, 5xx e timeouts cortam a taxa pela metade (redução
+multiplicativa) e bloqueiam o bucket por uma pausa que dobra a cada falha seguida,
+ou pelo tempo pedido no Retry-After, até RATE_LIMIT_BACKOFF_MAX. Assim a coleta roda na maior taxa que o site
+aceita sem bloquear, e a taxa atual de cada bucket fica exposta como métrica.
+"""
+import asyncio
+import os
+import random
+import time
+
+import metrics
+import settings  # noqa: F401  Carrega o .env antes de ler as configurações
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT", "1") == "1"
+RATE_LIMIT_INCREASE = float(os.getenv("RATE_LIMIT_INCREASE", 0.05))  # Req/s somados a cada resposta saudável
+RATE_LIMIT_DECREASE = float(os.getenv("RATE_LIMIT_DECREASE", 0.5))  # Fator aplicado à taxa em cada throttle
+RATE_LIMIT_BACKOFF_BASE = float(os.getenv("RATE_LIMIT_BACKOFF_BASE", 0.5))  # Pausa após o 1º throttle; dobra
+RATE_LIMIT_BACKOFF_MAX = float(os.getenv("RATE_LIMIT_BACKOFF_MAX", 120))  # Teto das pausas, inclusive do Retry-After
+RATE_LIMIT_JITTER = float(os.getenv("RATE_LIMIT_JITTER", 0.25))  # Variação aleatória das esperas (fração)
+
+# Taxa inicial, mínima e máxima (req/s) por ação. RATE_LIMITS sobrescreve no formato
+# "acao=inicial:minima:maxima,...", por exemplo "scroll=2:0.2:6,download=50:2:300".
+DEFAULT_ACTION_LIMITS = {
+    "navigate": (0.5, 0.05, 2.0),
+    "scroll": (1.0, 0.1, 4.0),
+    "login": (0.5, 0.2, 1.0),
+    "download": (20.0, 1.0, 200.0)
+}
+
+
+def _parse_limits(spec: str):
+    limits = dict(DEFAULT_ACTION_LIMITS)
+    for entry in spec.split(","):
+        action, _, values = entry.partition("=")
+        if not values:
+            continue
+        try:
+            initial, minimum, maximum = (float(value) for value in values.split(":"))
+        except ValueError:
+            print(f"Limite de taxa inválido em RATE_LIMITS: {entry!r} (use acao=inicial:minima:maxima)")
+            continue
+        limits[action.strip()] = (initial, minimum, maximum)
+    return limits
+
+
+ACTION_LIMITS = _parse_limits(os.getenv("RATE_LIMITS", ""))
+
+
+def parse_retry_after(value):
+    """Segundos pedidos pelo cabeçalho Retry-After (só a forma numérica), ou None."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttle_status(status) -> bool:
+    return status == 429 or (status is not None and status >= 500)
+
+
+class TokenBucket:
+    """Token bucket com taxa ajustada por aumento aditivo e redução multiplicativa."""
+
+    def __init__(self, name: str, rate: float, min_rate: float, max_rate: float):
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = 1.0
+        self.blocked_until = 0.0
+        self.consecutive_throttles = 0
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._publish()
+
+    @property
+    def capacity(self) -> float:
+        """Rajada máxima: um segundo de tokens na taxa atual (pelo menos um)."""
+        return max(1.0, self.rate)
+
+    def _refill(self, now: float):
+        if now > self._updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+
+    def _publish(self):
+        metrics.gauge(f"ratelimit.{self.name}.rate").set(round(self.rate, 3))
+
+    async def acquire(self):
+        """Espera até haver um token (e o bucket não estar em pausa) e o consome. Atende por ordem de chegada."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+                await asyncio.sleep(wait * (1.0 + random.uniform(0.0, RATE_LIMIT_JITTER)))
+
+    def success(self):
+        self.consecutive_throttles = 0
+        if self.rate < self.max_rate:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + RATE_LIMIT_INCREASE)
+            self._publish()
+
+    def throttle(self, retry_after: float = None):
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return  # Respostas das requisições que já estavam em voo contam como o mesmo evento
+        self._refill(now)
+        self.consecutive_throttles += 1
+        self.rate = max(self.min_rate, self.rate * RATE_LIMIT_DECREASE)
+        pause = retry_after if retry_after is not None else RATE_LIMIT_BACKOFF_BASE * 2 ** (self.consecutive_throttles - 1)
+        # Um Retry-After de horas pararia o host inteiro (e, pelas filas, a coleta); vale o teto
+        pause = min(RATE_LIMIT_BACKOFF_MAX, pause)
+        self.blocked_until = max(self.blocked_until, now + pause)
+        # Ao fim da pausa sai uma única requisição de teste; as demais seguem a taxa reduzida
+        self.tokens = 1.0
+        self._updated_at = self.blocked_until
+        metrics.counter(f"ratelimit.{self.name}.throttled").inc()
+        self._publish()
+
+
+class RateLimiter:
+    """Guarda um TokenBucket por (host, ação), criado sob demanda com os limites de ACTION_LIMITS."""
+
+    def __init__(self, limits: dict = None, enabled: bool = RATE_LIMIT_ENABLED):
+        self.limits = limits if limits is not None else ACTION_LIMITS
+        self.enabled = enabled
+        self._buckets = {}
+
+    def bucket(self, host: str, action: str) -> TokenBucket:
+        key = (host or "local", action)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            initial, minimum, maximum = self.limits.get(action, self.limits["navigate"])
+            bucket = self._buckets[key] = TokenBucket(f"{key[0]}.{action}", initial, minimum, maximum)
+        return bucket
+
+    async def acquire(self, host: str, action: str):
+        """Espera a vez de fazer uma requisição de `action` em `host`."""
+        if not self.enabled:
+            return
+        with metrics.timer(f"ratelimit.{action}.wait.seconds"):
+            await self.bucket(host, action).acquire()
+
+    def record(self, host: str, action: str, status: int = None, timeout: bool = False, retry_after=None):
+        """
+        Informa o resultado de uma requisição: 429, 5xx ou timeout reduzem a taxa;
+        2xx e 3xx a aumentam; os demais códigos (404, 403...) não mudam nada.
+        """
+        if not self.enabled:
+            return
+        bucket = self.bucket(host, action)
+        if timeout or is_throttle_status(status):
+            bucket.throttle(parse_retry_after(retry_after))
+        elif status is not None and status < 400:
+            bucket.success()
+
+    def rates(self) -> dict:
+        """Taxa atual de cada bucket, em req/s."""
+        return {bucket.name: round(bucket.rate, 3) for bucket in self._buckets.values()}
+
+
+LIMITER = RateLimiter()
+acquire = LIMITER.acquire
+record = LIMITER.record
@@ -0,0 +1,376 @@
+"""
+Esquema do banco: migrações versionadas, partições mensais de `images` e exportação em massa.
+
+As migrações ficam em MIGRATIONS, em ordem, e cada uma roda uma única vez numa transação
+própria, registrada em `schema_migrations`. Um advisory lock garante que dois processos
+subindo juntos não migrem ao mesmo tempo.
+
+A tabela `images` é particionada por mês em `collected_at`. Como a chave única de uma
+tabela particionada precisa incluir a coluna de partição, a unicidade global de
+`pinterest_id` fica na tabela `pin_ids`: um pin só entra em `images` se o seu ID entrou
+em `pin_ids` na mesma transação.
+
+A exportação usa COPY TO e grava as linhas conforme chegam do servidor, em JSONL ou em
+Parquet (com pyarrow), sem carregar a tabela em listas do Python.
+
+Uso:
+    python schema.py migrate
+    python schema.py export --format jsonl --output images.jsonl --since 2026-01-01
+    python schema.py export --format parquet --output images.parquet --board https://br.pinterest.com/...
+"""
+import argparse
+import asyncio
+import io
+import os
+from datetime import date, datetime, time
+
+import settings  # noqa: F401  Carrega o .env antes de ler as configurações
+
+SCHEMA_LOCK_ID = 0x6D617968656D  # Chave do advisory lock das migrações
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 3))
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", 10000))  # Linhas por row group no Parquet
+
+# O hash perceptual (64 bits) dividido em 4 faixas de 16 bits sem sinal, cada uma com um
+# índice de expressão. As consultas precisam usar exatamente estas expressões.
+PHASH_BAND_BITS = 16
+PHASH_BAND_EXPRESSIONS = [f"((phash >> {PHASH_BAND_BITS * band}) & 65535)::integer" for band in range(4)]
+
+# Colunas de `images` na ordem da tabela particionada (e da exportação)
+IMAGES_TABLE_COLUMNS = """
+    pinterest_id TEXT NOT NULL,
+    title TEXT,
+    description TEXT,
+    image_url TEXT,
+    board_url TEXT,
+    pin_url TEXT,
+    collected_at TIMESTAMP NOT NULL,
+    local_path TEXT,
+    content_hash TEXT,
+    mime_type TEXT,
+    width INTEGER,
+    height INTEGER,
+    file_size BIGINT,
+    phash BIGINT,
+    category TEXT,
+    category_score REAL,
+    embedding REAL[]
+"""
+IMAGES_COLUMN_NAMES = [line.split()[0] for line in IMAGES_TABLE_COLUMNS.strip().splitlines()]
+
+
+def _month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def _next_month(day: date) -> date:
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def _partition_name(month: date) -> str:
+    return f"images_y{month.year:04d}m{month.month:02d}"
+
+
+async def create_month_partitions(conn, first: date, last: date):
+    """Cria as partições mensais de `images` de `first` até `last` (inclusive) que ainda não existem."""
+    month = _month_start(first)
+    created = 0
+    while month <= last:
+        following = _next_month(month)
+        exists = await conn.fetchval("SELECT to_regclass($1) IS NOT NULL;", _partition_name(month))
+        if not exists:
+            try:
+                await conn.execute(
+                    f"CREATE TABLE {_partition_name(month)} PARTITION OF images "
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}');"
+                )
+                created += 1
+            except Exception as e:
+                # Acontece se a partição default já tem linhas desse mês; elas continuam lá
+                print(f"Não foi possível criar a partição {_partition_name(month)}: {e}")
+        month = following
+    return created
+
+
+async def _images_is_partitioned(conn) -> bool:
+    return await conn.fetchval("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('images');") or False
+
+
+async def _partition_images(conn):
+    """
+    Converte `images` numa tabela particionada por mês, copiando os dados existentes.
+    A tabela antiga é renomeada, os IDs vão para `pin_ids` e as linhas são copiadas
+    para partições criadas sob medida para o intervalo de datas existente.
+    """
+    await conn.execute("CREATE TABLE IF NOT EXISTS pin_ids (pinterest_id TEXT PRIMARY KEY);")
+    if await _images_is_partitioned(conn):
+        return
+    await conn.execute("ALTER TABLE images RENAME TO images_legacy;")
+    await conn.execute(
+        f"""
+        CREATE TABLE images ({IMAGES_TABLE_COLUMNS},
+            CONSTRAINT images_partitioned_pkey PRIMARY KEY (pinterest_id, collected_at)
+        ) PARTITION BY RANGE (collected_at);
+        CREATE TABLE images_default PARTITION OF images DEFAULT;
+        """
+    )
+    first, last = await conn.fetchrow("SELECT min(collected_at), max(collected_at) FROM images_legacy;")
+    today = date.today()
+    await create_month_partitions(conn, (first or datetime.now()).date(), max((last or datetime.now()).date(), today))
+
+    columns = ", ".join(IMAGES_COLUMN_NAMES)
+    source_columns = ", ".join(
+        "COALESCE(collected_at, now())" if column == "collected_at" else column for column in IMAGES_COLUMN_NAMES
+    )
+    await conn.execute(
+        f"""
+        INSERT INTO pin_ids (pinterest_id) SELECT DISTINCT pinterest_id FROM images_legacy
+        WHERE pinterest_id IS NOT NULL ON CONFLICT DO NOTHING;
+        INSERT INTO images ({columns})
+        SELECT DISTINCT ON (pinterest_id) {source_columns} FROM images_legacy WHERE pinterest_id IS NOT NULL;
+        DROP TABLE images_legacy;
+        """
+    )
+
+
+# (versão, descrição, SQL ou função async que recebe a conexão)
+MIGRATIONS = [
+    (1, "tabela images", """
+        CREATE TABLE IF NOT EXISTS images (
+            pinterest_id TEXT UNIQUE,
+            title TEXT,
+            description TEXT,
+            image_url TEXT,
+            board_url TEXT,
+            pin_url TEXT,
+            collected_at TIMESTAMP
+        );
+    """),
+    (2, "metadados do armazenamento local", """
+        ALTER TABLE images
+            ADD COLUMN IF NOT EXISTS local_path TEXT,
+            ADD COLUMN IF NOT EXISTS content_hash TEXT,
+            ADD COLUMN IF NOT EXISTS mime_type TEXT,
+            ADD COLUMN IF NOT EXISTS width INTEGER,
+            ADD COLUMN IF NOT EXISTS height INTEGER,
+            ADD COLUMN IF NOT EXISTS file_size BIGINT,
+            ADD COLUMN IF NOT EXISTS phash BIGINT;
+    """),
+    (3, "categorização e cache de embeddings", """
+        ALTER TABLE images
+            ADD COLUMN IF NOT EXISTS category TEXT,
+            ADD COLUMN IF NOT EXISTS category_score REAL,
+            ADD COLUMN IF NOT EXISTS embedding REAL[];
+        CREATE TABLE IF NOT EXISTS image_embeddings (
+            content_hash TEXT PRIMARY KEY,
+            category TEXT NOT NULL,
+            category_score REAL,
+            embedding REAL[],
+            model TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """),
+    (4, "fila de jobs", """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            dedupe_key TEXT UNIQUE,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            locked_by TEXT,
+            locked_until TIMESTAMPTZ,
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS jobs_claim_idx ON jobs (kind, available_at) WHERE status IN ('pending', 'running');
+    """),
+    (5, "images particionada por mês", _partition_images),
+    (6, "índices das consultas de images", """
+        CREATE INDEX IF NOT EXISTS images_content_hash_idx ON images (content_hash);
+        CREATE INDEX IF NOT EXISTS images_board_collected_idx ON images (board_url, collected_at);
+        CREATE INDEX IF NOT EXISTS images_collected_at_idx ON images (collected_at);
+        CREATE INDEX IF NOT EXISTS images_uncategorized_idx ON images (content_hash)
+            WHERE category IS NULL AND content_hash IS NOT NULL;
+    """),
+    # Ordem de inserção numerada pelo servidor, para o índice de pins conhecidos ler só o que é novo
+    # (collected_at é a hora da coleta, não a da gravação)
+    (7, "ordem de inserção em pin_ids", """
+        ALTER TABLE pin_ids ADD COLUMN IF NOT EXISTS seq BIGSERIAL;
+        CREATE INDEX IF NOT EXISTS pin_ids_seq_idx ON pin_ids (seq);
+    """),
+    # Busca de quase duplicatas sem varrer a tabela: candidatos por faixa do phash, ver database.find_near_duplicates
+    (8, "índices das faixas do phash", "".join(
+        f"CREATE INDEX IF NOT EXISTS images_phash_band{band}_idx ON images (({expression})) WHERE phash IS NOT NULL;\n"
+        for band, expression in enumerate(PHASH_BAND_EXPRESSIONS)
+    )),
+]
+
+
+async def migrate(pool, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Aplica as migrações pendentes e garante as partições dos próximos meses. Retorna as versões aplicadas."""
+    applied = []
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1);", SCHEMA_LOCK_ID)
+        try:
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+                """
+            )
+            done = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations;")}
+            for version, description, step in MIGRATIONS:
+                if version in done:
+                    continue
+                async with conn.transaction():
+                    if isinstance(step, str):
+                        await conn.execute(step)
+                    else:
+                        await step(conn)
+                    await conn.execute("INSERT INTO schema_migrations (version, description) VALUES ($1, $2);",
+                                       version, description)
+                applied.append(version)
+                print(f"Migração {version} aplicada: {description}.")
+
+            today = date.today()
+            horizon = today
+            for _ in range(months_ahead):
+                horizon = _next_month(horizon)
+            await create_month_partitions(conn, today, horizon)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1);", SCHEMA_LOCK_ID)
+    return applied
+
+
+def _export_query(since: date = None, until: date = None, board: str = None, columns=None):
+    """Monta o SELECT da exportação (uma linha JSON por pin) e seus parâmetros."""
+    columns = columns or IMAGES_COLUMN_NAMES
+    filters, params = [], []
+    if since:
+        params.append(datetime.combine(since, time.min))
+        filters.append(f"collected_at >= ${len(params)}")
+    if until:
+        params.append(datetime.combine(until, time.min))
+        filters.append(f"collected_at < ${len(params)}")
+    if board:
+        params.append(board)
+        filters.append(f"board_url = ${len(params)}")
+    where = f"WHERE {' AND '.join(filters)}" if filters else ""
+    query = f"SELECT row_to_json(t)::text FROM (SELECT {', '.join(columns)} FROM images {where}) t"
+    return query, params
+
+
+# Com CSV e aspas/delimitador que nunca aparecem num JSON, o COPY devolve cada linha
+# exatamente como o row_to_json a gerou (no formato text ele escaparia as barras invertidas)
+_RAW_COPY_OPTIONS = {"format": "csv", "quote": "\x01", "delimiter": "\x02"}
+
+
+async def export_jsonl(pool, output_path: str, since=None, until=None, board=None) -> int:
+    """Exporta `images` para JSONL via COPY TO, gravando direto no arquivo. Retorna as linhas exportadas."""
+    query, params = _export_query(since, until, board)
+    async with pool.acquire() as conn:
+        status = await conn.copy_from_query(query, *params, output=output_path, **_RAW_COPY_OPTIONS)
+    return int(status.split()[-1])
+
+
+class _ParquetSink:
+    """Recebe os pedaços do COPY, junta linhas completas e grava um row group a cada `batch_rows` linhas."""
+
+    def __init__(self, output_path: str, batch_rows: int = EXPORT_BATCH_ROWS):
+        import pyarrow as pa
+        import pyarrow.json as pa_json
+        import pyarrow.parquet as pq
+
+        self.schema = pa.schema([
+            ("pinterest_id", pa.string()), ("title", pa.string()), ("description", pa.string()),
+            ("image_url", pa.string()), ("board_url", pa.string()), ("pin_url", pa.string()),
+            ("collected_at", pa.timestamp("us")), ("local_path", pa.string()), ("content_hash", pa.string()),
+            ("mime_type", pa.string()), ("width", pa.int32()), ("height", pa.int32()),
+            ("file_size", pa.int64()), ("phash", pa.int64()), ("category", pa.string()),
+            ("category_score", pa.float32()), ("embedding", pa.list_(pa.float32()))
+        ])
+        self._read_json = pa_json.read_json
+        self._parse_options = pa_json.ParseOptions(explicit_schema=self.schema, unexpected_field_behavior="ignore")
+        self._writer = pq.ParquetWriter(output_path, self.schema, compression="zstd")
+        self.batch_rows = batch_rows
+        self.rows = 0
+        self._partial = b""
+        self._lines = []
+
+    async def write(self, chunk: bytes):
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = lines.pop()
+        self._lines.extend(lines)
+        if len(self._lines) >= self.batch_rows:
+            self._write()
+
+    def _write(self):
+        if not self._lines:
+            return
+        table = self._read_json(io.BytesIO(b"\n".join(self._lines)), parse_options=self._parse_options)
+        self._writer.write_table(table)
+        self.rows += len(self._lines)
+        self._lines = []
+
+    def close(self):
+        if self._partial:
+            self._lines.append(self._partial)
+            self._partial = b""
+        self._write()
+        self._writer.close()
+
+
+async def export_parquet(pool, output_path: str, since=None, until=None, board=None,
+                         batch_rows: int = EXPORT_BATCH_ROWS) -> int:
+    """Exporta `images` para Parquet em row groups de `batch_rows` linhas. Retorna as linhas exportadas."""
+    sink = _ParquetSink(output_path, batch_rows)
+    query, params = _export_query(since, until, board, sink.schema.names)
+    try:
+        async with pool.acquire() as conn:
+            await conn.copy_from_query(query, *params, output=sink.write, **_RAW_COPY_OPTIONS)
+    finally:
+        sink.close()
+    return sink.rows
+
+
+async def _run(args):
+    from database import create_db_pool
+
+    pool = await create_db_pool()
+    if not pool:
+        print("Não foi possível estabelecer conexão com o banco de dados. Encerrando.")
+        return
+    try:
+        if args.command == "migrate":
+            applied = await migrate(pool)
+            print(f"Esquema atualizado ({len(applied)} migrações aplicadas).")
+        else:
+            await migrate(pool)
+            export = export_parquet if args.format == "parquet" else export_jsonl
+            rows = await export(pool, args.output, args.since, args.until, args.board)
+            print(f"{rows} linhas exportadas para {args.output}.")
+    finally:
+        await pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrações e exportação da tabela images.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="aplica as migrações pendentes e cria as próximas partições")
+    export = commands.add_parser("export", help="exporta images via COPY TO em memória constante")
+    export.add_argument("--format", choices=("jsonl", "parquet"), default="jsonl")
+    export.add_argument("--output", required=True)
+    export.add_argument("--since", type=date.fromisoformat, help="collected_at a partir desta data (AAAA-MM-DD)")
+    export.add_argument("--until", type=date.fromisoformat, help="collected_at antes desta data (AAAA-MM-DD)")
+    export.add_argument("--board", help="só os pins deste board_url")
+    asyncio.run(_run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
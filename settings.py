@@ -0,0 +1,28 @@
+"""
+Configuração compartilhada pelas etapas (crawl, fetch, ingest).
+
+Carrega o .env uma única vez e define o que mais de um módulo usa. Não depende de
+nada pesado, para que cada etapa importe só as bibliotecas de que precisa.
+"""
+import os
+
+try:
+    from dotenv import load_dotenv
+except ImportError:  # python-dotenv é opcional: sem ele valem só as variáveis do ambiente
+    load_dotenv = None
+
+if load_dotenv:
+    # Carrega as variáveis de ambiente do arquivo .env
+    load_dotenv()
+
+IMAGE_SAVE_DIR = "IMAGENS"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
+
+# Metadados do armazenamento local gravados junto com o pin
+IMAGE_STORAGE_FIELDS = ("content_hash", "mime_type", "width", "height", "file_size", "phash")
+
+# Observabilidade: resumo JSON no fim da execução (METRICS_OUTPUT vazio imprime na tela),
+# endpoint HTTP opcional com as métricas ao vivo e profiler por amostragem opcional
+METRICS_OUTPUT = os.getenv("METRICS_OUTPUT")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+PROFILE_OUTPUT = os.getenv("PROFILE_OUTPUT")
@@ -0,0 +1,194 @@
+"""
+Spool local entre as etapas da linha de comando: crawl -> fetch -> ingest.
+
+Cada etapa grava seus registros (um pin por linha, em JSON) em segmentos só de
+acréscimo, SPOOL_DIR/<etapa>/<data>-<pid>-<n>.jsonl. Cada execução abre segmentos
+novos e nunca reescreve os antigos. As linhas vão para o disco com fsync a cada
+SPOOL_SYNC_EVERY registros, então uma queda perde no máximo esse tanto, e a linha
+cortada no fim de um segmento é ignorada na leitura.
+
+Quem consome um spool guarda um checkpoint próprio com o offset, em bytes, já
+processado de cada segmento (SPOOL_DIR/<etapa>/.checkpoint-<consumidor>.json),
+trocado de forma atômica depois de cada lote. Uma execução interrompida recomeça do
+último checkpoint; o lote que estava em andamento é lido de novo, e as etapas
+seguintes toleram repetições (o armazenamento é por conteúdo e o banco ignora
+pinterest_id repetidos).
+"""
+import glob
+import json
+import os
+from datetime import datetime
+
+import metrics
+import settings  # noqa: F401  Carrega o .env antes de ler as configurações
+
+SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")
+SPOOL_SYNC_EVERY = int(os.getenv("SPOOL_SYNC_EVERY", 100))  # Registros entre dois fsync
+SPOOL_SEGMENT_MAX_BYTES = int(os.getenv("SPOOL_SEGMENT_MAX_MB", 64)) * 1024 * 1024
+SPOOL_BATCH_SIZE = int(os.getenv("SPOOL_BATCH_SIZE", 500))  # Registros por lote (e por checkpoint) na leitura
+
+
+def _fsync_dir(path: str):
+    """Garante que a criação ou troca de um arquivo no diretório chegou ao disco (onde o SO permite)."""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SpoolWriter:
+    """Acrescenta registros aos segmentos de uma etapa, trocando de segmento ao passar de `segment_max_bytes`."""
+
+    def __init__(self, stage: str, directory: str = SPOOL_DIR, sync_every: int = SPOOL_SYNC_EVERY,
+                 segment_max_bytes: int = SPOOL_SEGMENT_MAX_BYTES):
+        self.stage = stage
+        self.path = os.path.join(directory, stage)
+        self.sync_every = sync_every
+        self.segment_max_bytes = segment_max_bytes
+        self.written = 0
+        self._file = None
+        self._pending = 0
+        self._segments = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _open_segment(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._segments += 1
+        name = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}-{self._segments:04d}.jsonl"
+        self._file = open(os.path.join(self.path, name), "ab")
+        _fsync_dir(self.path)
+
+    def append(self, record: dict):
+        """Grava um registro. Datas e outros valores não JSON viram texto."""
+        line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+        if self._file is not None and self._file.tell() + len(line) > self.segment_max_bytes:
+            self.close()
+        if self._file is None:
+            self._open_segment()
+        self._file.write(line)
+        self._pending += 1
+        self.written += 1
+        metrics.counter(f"spool.{self.stage}.records").inc()
+        if self._pending >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """Força os registros pendentes para o disco."""
+        if self._file is not None and self._pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending = 0
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+class SpoolReader:
+    """Lê os segmentos de uma etapa a partir do checkpoint de um consumidor."""
+
+    def __init__(self, stage: str, consumer: str, directory: str = SPOOL_DIR):
+        self.stage = stage
+        self.path = os.path.join(directory, stage)
+        self.checkpoint_path = os.path.join(self.path, f".checkpoint-{consumer}.json")
+        self.offsets = self._load_checkpoint()
+
+    def _load_checkpoint(self) -> dict:
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        try:
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Checkpoint ilegível em {self.checkpoint_path} ({e}); o spool será lido desde o início.")
+            return {}
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.path, "*.jsonl")))
+
+    def pending_bytes(self) -> int:
+        """Bytes ainda não processados por este consumidor."""
+        return sum(max(0, os.path.getsize(segment) - self.offsets.get(os.path.basename(segment), 0))
+                   for segment in self.segments())
+
+    def batches(self, batch_size: int = SPOOL_BATCH_SIZE):
+        """
+        Gera (registros, posição) a partir do checkpoint, em lotes de até `batch_size`
+        registros de um mesmo segmento. Depois de processar um lote, passe a posição
+        para `commit`. Linhas sem o "\\n" final (ainda sendo escritas ou cortadas por
+        uma queda) ficam para depois; linhas que não são JSON válido são puladas.
+        """
+        for segment in self.segments():
+            name = os.path.basename(segment)
+            offset = start = self.offsets.get(name, 0)
+            records = []
+            with open(segment, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    offset += len(line)
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        metrics.counter(f"spool.{self.stage}.invalid_lines").inc()
+                        print(f"Linha inválida ignorada em {segment} (byte {offset - len(line)}).")
+                        continue
+                    if len(records) >= batch_size:
+                        yield records, (name, offset)
+                        records, start = [], offset
+            if offset > start:
+                yield records, (name, offset)
+
+    def read_all(self):
+        """Todos os registros completos do spool, ignorando o checkpoint."""
+        for segment in self.segments():
+            with open(segment, "rb") as f:
+                for line in f:
+                    if line.endswith(b"\n"):
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            continue
+
+    def commit(self, position):
+        """Registra que tudo até `position` foi processado, trocando o arquivo de checkpoint atomicamente."""
+        name, offset = position
+        self.offsets[name] = offset
+        temp_path = f"{self.checkpoint_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.offsets, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.checkpoint_path)
+        _fsync_dir(self.path)
+
+
+class SpoolPipeline:
+    """
+    Destino de crawl_targets que só grava os pins no spool, sem baixar nem tocar no
+    banco. Tem a mesma interface usada do CrawlPipeline (`feed`, `collected`).
+    """
+
+    def __init__(self, writer: SpoolWriter):
+        self.writer = writer
+        self.collected = 0
+
+    async def feed(self, pins):
+        """Consome um iterável assíncrono de pins, gravando cada um no spool. Retorna quantos foram."""
+        fed = 0
+        async for pin_data in pins:
+            self.writer.append(pin_data)
+            self.collected += 1
+            fed += 1
+        return fed
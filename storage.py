@@ -0,0 +1,416 @@
+"""
+Download das imagens para o armazenamento local endereçado pelo conteúdo.
+
+Depende do aiohttp e, opcionalmente, do Pillow (dimensões, hash perceptual e
+transcodificação); não carrega o navegador nem o driver do banco.
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote_to_bytes, urlsplit
+
+import aiohttp
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow é opcional: sem ele não há dimensões nem hash perceptual
+    Image = None
+
+import metrics
+import rate_limiter
+from image_urls import image_url_candidates
+from settings import IMAGE_SAVE_DIR, IMAGE_STORAGE_FIELDS, USER_AGENT
+from spool import SPOOL_BATCH_SIZE, SpoolReader, SpoolWriter
+
+# Configurações de download
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", 16))
+DOWNLOAD_MAX_RETRIES = int(os.getenv("DOWNLOAD_MAX_RETRIES", 3))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", 30))
+DOWNLOAD_BACKOFF_BASE = float(os.getenv("DOWNLOAD_BACKOFF_BASE", 0.5))  # Pausa antes da 2ª tentativa; dobra a cada uma
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Armazenamento endereçado pelo conteúdo (IMAGENS/ab/cd/<sha256>.<ext>)
+MIME_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif",
+    "image/avif": "avif"
+}
+
+# Transcodificação opcional após o download ("webp" ou "avif"; vazio mantém o arquivo original),
+# feita num pool de processos e limitada a IMAGE_MAX_DIMENSION pixels no maior lado
+IMAGE_TRANSCODE_FORMAT = os.getenv("IMAGE_TRANSCODE_FORMAT", "").lower()
+IMAGE_TRANSCODE_QUALITY = int(os.getenv("IMAGE_TRANSCODE_QUALITY", 80))
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 1024))
+IMAGE_TRANSCODE_WORKERS = int(os.getenv("IMAGE_TRANSCODE_WORKERS", os.cpu_count() or 1))
+
+
+def sniff_mime_type(head: bytes, fallback: str = None):
+    """Identifica o tipo real da imagem pelos primeiros bytes, sem confiar na extensão da URL."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if head[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return fallback or "application/octet-stream"
+
+
+def content_path(save_dir: str, digest: str, mime_type: str) -> str:
+    """Caminho endereçado pelo conteúdo: <dir>/ab/cd/<sha256>.<ext>."""
+    extension = MIME_EXTENSIONS.get(mime_type, "bin")
+    return os.path.join(save_dir, digest[:2], digest[2:4], f"{digest}.{extension}")
+
+
+def describe_image(path: str):
+    """
+    Lê as dimensões e calcula o hash perceptual (dHash de 64 bits) da imagem.
+
+    O hash vem como inteiro com sinal, pronto para uma coluna BIGINT; imagens quase
+    iguais diferem em poucos bits. Sem o Pillow, ou se a imagem não decodificar,
+    retorna (None, None, None).
+    """
+    if Image is None:
+        return None, None, None
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except Exception:
+        return None, None, None
+    phash = 0
+    for row in range(8):
+        for column in range(8):
+            phash = (phash << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    if phash >= 1 << 63:
+        phash -= 1 << 64
+    return width, height, phash
+
+
+def decode_data_uri(data_uri: str):
+    """Decodifica um data: URI em (bytes, mime_type). Levanta ValueError se estiver malformado."""
+    header, separator, data = data_uri.partition(",")
+    if not header.startswith("data:") or not separator:
+        raise ValueError("data: URI malformado")
+    mime_type = header[5:].split(";")[0] or None
+    if header.endswith(";base64"):
+        return base64.b64decode(data, validate=False), mime_type
+    return unquote_to_bytes(data), mime_type
+
+
+def transcode_image(source_path: str, output_path: str, image_format: str, max_dimension: int, quality: int):
+    """
+    Reduz a imagem a `max_dimension` no maior lado e regrava em WebP ou AVIF.
+
+    Roda num processo do pool de transcodificação. Retorna (bytes, sha256) do arquivo
+    gerado, ou None quando a imagem é animada, não decodifica, o formato não é suportado
+    pelo Pillow instalado ou o resultado não ficou menor que o original.
+    """
+    if image_format == "avif":
+        try:
+            import pillow_avif  # noqa: F401  Plugin para versões do Pillow sem AVIF nativo
+        except ImportError:
+            pass
+    try:
+        with Image.open(source_path) as image:
+            if getattr(image, "is_animated", False):
+                return None
+            image.draft("RGB", (max_dimension, max_dimension))
+            image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            image.save(output_path, format=image_format.upper(), quality=quality)
+    except Exception:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return None
+
+    size = os.path.getsize(output_path)
+    if size >= os.path.getsize(source_path):
+        os.remove(output_path)
+        return None
+    with open(output_path, "rb") as f:
+        return size, hashlib.sha256(f.read()).hexdigest()
+
+
+class ImageDownloader:
+    """
+    Baixa imagens em paralelo com uma sessão HTTP compartilhada.
+
+    As conexões são reaproveitadas entre downloads, o número de downloads
+    simultâneos é limitado por `concurrency` e cada arquivo é gravado em pedaços
+    num arquivo temporário que só é renomeado para o destino final quando completo.
+    Com `transcode_format`, o arquivo baixado é reduzido e regravado em WebP/AVIF
+    num pool de processos antes de ir para o armazenamento.
+    """
+
+    def __init__(self, save_dir: str = IMAGE_SAVE_DIR, concurrency: int = DOWNLOAD_CONCURRENCY,
+                 max_retries: int = DOWNLOAD_MAX_RETRIES, backoff_base: float = DOWNLOAD_BACKOFF_BASE,
+                 timeout: float = DOWNLOAD_TIMEOUT, transcode_format: str = IMAGE_TRANSCODE_FORMAT,
+                 max_dimension: int = IMAGE_MAX_DIMENSION, quality: int = IMAGE_TRANSCODE_QUALITY):
+        self.save_dir = save_dir
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        self.transcode_format = transcode_format
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.stats = {"downloaded": 0, "existing": 0, "failed": 0, "retries": 0, "fallbacks": 0, "transcoded": 0,
+                      "bytes": 0, "bytes_stored": 0, "seconds": 0.0}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._session = None
+        self._transcoder = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        """Cria a sessão HTTP, o pool de conexões e, se configurado, o pool de transcodificação."""
+        os.makedirs(self.save_dir, exist_ok=True)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"User-Agent": USER_AGENT}
+        )
+        if self.transcode_format:
+            if Image is None:
+                print("Pillow não está instalado; as imagens serão guardadas sem transcodificação.")
+            else:
+                self._transcoder = ProcessPoolExecutor(max_workers=IMAGE_TRANSCODE_WORKERS)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._transcoder is not None:
+            self._transcoder.shutdown(wait=True)
+            self._transcoder = None
+
+    async def download(self, image_url: str, fallback_urls=()) -> dict:
+        """
+        Baixa uma imagem para o armazenamento endereçado pelo conteúdo.
+
+        Se `image_url` falhar, tenta as URLs de `fallback_urls` em ordem (outras
+        resoluções da mesma imagem). Retorna um dicionário com a URL usada, o caminho,
+        o status ("downloaded", "existing" quando o mesmo conteúdo já estava armazenado,
+        ou "failed"), os bytes recebidos, a latência em segundos, as tentativas e os
+        metadados do arquivo guardado (content_hash, mime_type, width, height,
+        file_size e phash).
+        """
+        urls = [url for url in dict.fromkeys((image_url, *fallback_urls)) if url]
+        result = self._empty_result(image_url)
+        for position, url in enumerate(urls):
+            if position:
+                self.stats["fallbacks"] += 1
+                metrics.counter("download.fallbacks").inc()
+            result = await self._download_one(url)
+            if result["status"] != "failed":
+                break
+
+        if result["status"] == "downloaded":
+            self.stats["downloaded"] += 1
+            self.stats["bytes"] += result["bytes"]
+            self.stats["bytes_stored"] += result["file_size"]
+            self.stats["seconds"] += result["elapsed"]
+            metrics.counter("download.count").inc()
+            metrics.counter("download.bytes").inc(result["bytes"])
+            metrics.counter("download.bytes_stored").inc(result["file_size"])
+            metrics.histogram("download.seconds").observe(result["elapsed"])
+        elif result["status"] == "existing":
+            self.stats["existing"] += 1
+            metrics.counter("download.duplicate_content").inc()
+        else:
+            self.stats["failed"] += 1
+            metrics.counter("download.errors").inc()
+        if result["file_size"] is not None:
+            metrics.histogram("download.file_size").observe(result["file_size"])
+        return result
+
+    @staticmethod
+    def _empty_result(image_url: str) -> dict:
+        return {"image_url": image_url, "path": None, "status": "failed", "bytes": 0, "elapsed": 0.0,
+                "attempts": 0, "content_hash": None, "mime_type": None, "width": None, "height": None,
+                "file_size": None, "phash": None}
+
+    async def _download_one(self, image_url: str) -> dict:
+        """Baixa (ou decodifica, se for data: URI) uma única URL, com novas tentativas para erros transitórios."""
+        result = self._empty_result(image_url)
+        async with self._semaphore:
+            started = time.perf_counter()
+            for attempt in range(1, self.max_retries + 2):
+                result["attempts"] = attempt
+                try:
+                    temp_path, written, digest, mime_type = await self._fetch_to_temp(image_url)
+                    result.update(bytes=written, file_size=written, content_hash=digest, mime_type=mime_type)
+                    break
+                except aiohttp.ClientResponseError as e:
+                    print(f"Erro ao baixar {image_url}: HTTP {e.status}")
+                    break
+                except (_RetryableDownloadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = e
+                except Exception as e:
+                    print(f"Exceção ao baixar {image_url[:200]}: {e}")
+                    break
+
+                if attempt > self.max_retries:
+                    print(f"Erro ao baixar {image_url} após {attempt} tentativas: {error}")
+                    break
+                self.stats["retries"] += 1
+                metrics.counter("download.retries").inc()
+                # 429, 5xx e timeouts já seguram o bucket no rate_limiter; os demais erros (corpo
+                # cortado, por exemplo) e o limitador desligado ficam com a pausa exponencial
+                if not (rate_limiter.LIMITER.enabled and isinstance(error, _LIMITER_RECORDED_ERRORS)):
+                    await asyncio.sleep(self.backoff_base * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            result["elapsed"] = time.perf_counter() - started
+
+        if result["content_hash"]:
+            if self._transcoder is not None and result["mime_type"] not in ("image/gif", self._transcoded_mime()):
+                temp_path = await self._transcode(temp_path, result)
+            file_path = content_path(self.save_dir, result["content_hash"], result["mime_type"])
+            result.update(path=file_path, status=self._store(temp_path, file_path))
+            result["width"], result["height"], result["phash"] = await asyncio.get_running_loop().run_in_executor(
+                None, describe_image, file_path)
+        return result
+
+    def _transcoded_mime(self) -> str:
+        return f"image/{self.transcode_format}"
+
+    async def _transcode(self, temp_path: str, result: dict) -> str:
+        """Transcodifica o arquivo temporário no pool de processos. Retorna o caminho do arquivo a guardar."""
+        output_path = f"{temp_path}.{self.transcode_format}"
+        with metrics.timer("transcode.seconds"):
+            transcoded = await asyncio.get_running_loop().run_in_executor(
+                self._transcoder, transcode_image, temp_path, output_path, self.transcode_format,
+                self.max_dimension, self.quality)
+        if not transcoded:
+            metrics.counter("transcode.skipped").inc()
+            return temp_path
+        os.remove(temp_path)
+        result["file_size"], result["content_hash"] = transcoded
+        result["mime_type"] = self._transcoded_mime()
+        self.stats["transcoded"] += 1
+        metrics.counter("transcode.count").inc()
+        return output_path
+
+    @staticmethod
+    def _store(temp_path: str, file_path: str) -> str:
+        """Move o arquivo temporário para o caminho do conteúdo, a menos que ele já exista."""
+        if os.path.exists(file_path):
+            os.remove(temp_path)
+            return "existing"
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.replace(temp_path, file_path)
+        return "downloaded"
+
+    def _temp_path(self) -> str:
+        temp_dir = os.path.join(self.save_dir, ".incoming")
+        os.makedirs(temp_dir, exist_ok=True)
+        return os.path.join(temp_dir, f"{os.getpid()}.{id(asyncio.current_task())}.part")
+
+    async def _fetch_to_temp(self, image_url: str):
+        """
+        Faz o GET e grava o corpo em pedaços num arquivo temporário, calculando o
+        SHA-256 e identificando o tipo real durante o streaming. Levanta erro para
+        status não-200. Data: URIs são decodificados no próprio processo, sem rede.
+        Retorna (caminho temporário, bytes, sha256, mime_type).
+        """
+        temp_path = self._temp_path()
+        if image_url.startswith("data:"):
+            body, declared_mime = decode_data_uri(image_url)
+            with open(temp_path, "wb") as f:
+                f.write(body)
+            metrics.counter("download.data_uris").inc()
+            return temp_path, len(body), hashlib.sha256(body).hexdigest(), sniff_mime_type(body[:16], declared_mime)
+
+        digest = hashlib.sha256()
+        head = b""
+        written = 0
+        host = urlsplit(image_url).hostname
+        await rate_limiter.acquire(host, "download")
+        try:
+            async with self._session.get(image_url) as response:
+                rate_limiter.record(host, "download", response.status, retry_after=response.headers.get("Retry-After"))
+                if response.status == 429 or response.status >= 500:
+                    raise _RetryableDownloadError(f"HTTP {response.status}")
+                if response.status != 200:
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, response.history, status=response.status,
+                        message=response.reason or ""
+                    )
+                with open(temp_path, "wb") as f:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        if len(head) < 16:
+                            head += chunk[:16]
+                        digest.update(chunk)
+                        f.write(chunk)
+                        written += len(chunk)
+            return temp_path, written, digest.hexdigest(), sniff_mime_type(head, response.content_type)
+        except BaseException as e:
+            if isinstance(e, (asyncio.TimeoutError, aiohttp.ClientConnectionError)):
+                rate_limiter.record(host, "download", timeout=True)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class _RetryableDownloadError(Exception):
+    """Resposta HTTP que vale a pena tentar de novo (429 ou 5xx)."""
+
+
+# Falhas que _fetch_to_temp informa ao rate_limiter, que já pausa o bucket do host
+_LIMITER_RECORDED_ERRORS = (_RetryableDownloadError, asyncio.TimeoutError, aiohttp.ClientConnectionError)
+
+
+async def download_pin(downloader: ImageDownloader, pin_data: dict) -> dict:
+    """Baixa a imagem de um pin (tentando as outras resoluções se preciso) e anota o resultado no próprio pin."""
+    if pin_data.get("image_url"):
+        image_url, *fallback_urls = image_url_candidates(pin_data)
+        result = await downloader.download(image_url, fallback_urls)
+        pin_data["image_url"] = result["image_url"]
+        pin_data["local_path"] = result["path"]
+        pin_data.update({field: result[field] for field in IMAGE_STORAGE_FIELDS})
+    return pin_data
+
+
+async def fetch_from_spool(source: str = "crawl", target: str = "fetch", batch_size: int = SPOOL_BATCH_SIZE):
+    """
+    Etapa `fetch` da linha de comando: baixa as imagens dos pins do spool `source` e
+    grava os pins completos (caminho local e metadados da imagem) no spool `target`.
+
+    O checkpoint avança a cada lote, depois que o lote já está no spool de saída;
+    interrompida, a etapa recomeça do lote em andamento. Retorna quantos pins processou.
+    """
+    reader = SpoolReader(source, target)
+    processed = 0
+    with SpoolWriter(target) as writer:
+        async with ImageDownloader() as downloader:
+            for records, position in reader.batches(batch_size):
+                await asyncio.gather(*(download_pin(downloader, pin_data) for pin_data in records))
+                for pin_data in records:
+                    writer.append(pin_data)
+                writer.sync()
+                reader.commit(position)
+                processed += len(records)
+                print(f"Lote baixado: {len(records)} pins ({processed} nesta execução).")
+
+    stats = downloader.stats
+    print(f"--- Downloads concluídos: {processed} pins do spool '{source}' ---")
+    print(f"Imagens baixadas localmente: {stats['downloaded']} novas, "
+          f"{stats['existing']} com conteúdo já armazenado, "
+          f"{stats['failed']} falhas ({stats['retries']} novas tentativas)")
+    print(f"Bytes baixados: {stats['bytes']}, gravados em disco: {stats['bytes_stored']}")
+    return processed